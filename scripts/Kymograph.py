@@ -40,18 +40,54 @@ sizeC as input.
 # @since 3.0
 
 
-from omero.gateway import BlitzGateway
+from omero.gateway import BlitzGateway, MapAnnotationWrapper
 import omero
 import omero.util.script_utils as script_utils
-from omero.rtypes import rlong, rstring, robject, unwrap
+from omero.rtypes import rlist, rlong, rstring, robject, unwrap
 import omero.scripts as scripts
-from numpy import zeros, hstack, vstack, asarray, math
+import numpy
+from numpy import zeros, hstack, asarray, arange, clip, \
+    floor, minimum, newaxis, rint, issubdtype, integer, frombuffer
+import hashlib
 import logging
+import math
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from cStringIO import StringIO
 
 logger = logging.getLogger('kymograph')
 
+PIXEL_TYPES = {
+    "int8": numpy.int8,
+    "uint8": numpy.uint8,
+    "int16": numpy.int16,
+    "uint16": numpy.uint16,
+    "int32": numpy.int32,
+    "uint32": numpy.uint32,
+    "float": numpy.float32,
+    "double": numpy.float64}
+
+# Limits for fetching raw pixel data of following timepoints in one call
+MAX_READ_AHEAD = 16
+READ_AHEAD_BYTES = 32 * 1024 * 1024
+
+# Kymographs bigger than this are assembled in memory-mapped temporary files
+MEMMAP_BYTES = 1024 * 1024 * 1024
+
+# Maximum number of sessions creating kymographs in parallel
+MAX_WORKERS = 8
+
+# Map annotations on kymographs record the ROI they were created from
+KYMOGRAPH_NS = "omero.kymograph.map_ann"
+# Script parameters that change the kymograph created from an ROI
+FINGERPRINT_PARAMS = ["Line_Width", "Use_All_Timepoints", "Sampling",
+                      "Profile"]
+
+# Maximum number of new kymographs to update metadata for in one call
+METADATA_BATCH = 500
+
 
 def get_line_data(image, x1, y1, x2, y2, line_w=2, the_z=0, the_c=0, the_t=0):
     """
@@ -143,6 +179,33 @@ def get_line_data(image, x1, y1, x2, y2, line_w=2, the_z=0, the_c=0, the_t=0):
     return rgb_plane[::, ::, 0]
 
 
+def points_string_to_array(string):
+    """
+    Convert string to a float array of (x,y) points, with shape (N, 2).
+
+    Expects string in format generated from omero.model.ShapeI.getPoints()
+    e.g. "points[309,427, 366,503]" or "309,427 366,503".
+    Only the first list of the legacy "points[] points1[] points2[]" format
+    is used.
+    """
+    string = string.strip()
+    if string.startswith("points"):
+        start = string.find("[")
+        end = string.find("]", start)
+        if start < 0 or end < 0:
+            raise ValueError(
+                "Unrecognised ROI shape 'points' string: %s" % string)
+        string = string[start + 1:end]
+    try:
+        coords = numpy.fromstring(string.replace(",", " "),
+                                  dtype=numpy.float64, sep=" ")
+    except ValueError:
+        coords = numpy.empty(0)
+    if coords.size == 0 or coords.size % 2 != 0:
+        raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return coords.reshape(-1, 2)
+
+
 def points_string_to_xy_list(string):
     """
     Convert string to list of (x,y) points.
@@ -150,20 +213,285 @@ def points_string_to_xy_list(string):
     Expects string in format generated from omero.model.ShapeI.getPoints()
     e.g. "points[309,427, 366,503]" to [(309,427), (366,503)]
     """
-    point_lists = string.strip().split("points")
-    if len(point_lists) < 2:
-        if len(point_lists) == 1 and point_lists[0]:
-            xys = point_lists[0].split()
-            xy_list = [tuple(map(float, xy.split(','))) for xy in xys]
-            return xy_list
-        raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return [tuple(xy) for xy in points_string_to_array(string).tolist()]
+
+
+def line_length(x1, y1, x2, y2):
+    """Return the length in whole pixels of the kymograph row for a line."""
+    return int(math.sqrt(math.pow(x2 - x1, 2) + math.pow(y2 - y1, 2)))
+
+
+def polyline_length(points):
+    """Return the length in whole pixels of the row for a polyline."""
+    return sum([line_length(x1, y1, x2, y2) for (x1, y1), (x2, y2)
+                in zip(points[:-1], points[1:])])
+
+
+def line_sampling_grid(x1, y1, x2, y2, line_w=2):
+    """
+    Calculate the coordinates to sample covering the specified line.
+
+    Returns (xs, ys), 2d float arrays of shape (line_w, length) with x1,y1
+    to the left of each row, the same orientation as get_line_data().
+    The grid only depends on the line, so it can be reused for every
+    Z, C and T.
+
+    @param x1, y1, x2, y2:  Coordinates of line
+    @param line_w:          Width of the line we want
+    """
+    length = line_length(x1, y1, x2, y2)
+    rads = math.atan2(y2 - y1, x2 - x1)
+    cos_r = math.cos(rads)
+    sin_r = math.sin(rads)
+
+    along = arange(length, dtype=float)[newaxis, :]
+    across = (arange(line_w, dtype=float) - (line_w - 1) / 2.0)[:, newaxis]
+    xs = x1 + along * cos_r - across * sin_r
+    ys = y1 + along * sin_r + across * cos_r
+    return xs, ys
+
+
+def polyline_sampling_grid(points, line_w=2):
+    """
+    Calculate the coordinates to sample covering each segment of a polyline.
+
+    Segments are joined horizontally, as in polyline_kymograph().
+
+    @param points:          List of (x,y) points
+    @param line_w:          Width of the line we want
+    """
+    grids = [line_sampling_grid(x1, y1, x2, y2, line_w) for (x1, y1), (x2, y2)
+             in zip(points[:-1], points[1:])]
+    return hstack([g[0] for g in grids]), hstack([g[1] for g in grids])
+
+
+def line_sampler(image, xs, ys):
+    """
+    Prepare bilinear interpolation of raw pixel data at xs, ys.
+
+    Returns a dict with the 'tile' (x, y, w, h) of the image that covers all
+    the coordinates and the flat 'index' and 'weight' of the 4 neighbouring
+    pixels within that tile for each coordinate. Coordinates outside the
+    image get zero weight.
+
+    @param image:           ImageWrapper object
+    @param xs, ys:          Coordinates from line_sampling_grid()
+    """
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    # Always fetch at least 1 pixel so we know the dtype
+    x0 = min(max(int(math.floor(xs.min())), 0), size_x - 1)
+    y0 = min(max(int(math.floor(ys.min())), 0), size_y - 1)
+    x_end = min(max(int(math.floor(xs.max())) + 2, x0 + 1), size_x)
+    y_end = min(max(int(math.floor(ys.max())) + 2, y0 + 1), size_y)
+    w = x_end - x0
+    h = y_end - y0
+
+    fx = xs - x0
+    fy = ys - y0
+    inside = (fx >= 0) & (fx <= w - 1) & (fy >= 0) & (fy <= h - 1)
+    ix = clip(floor(fx), 0, w - 1).astype(int)
+    iy = clip(floor(fy), 0, h - 1).astype(int)
+    ix1 = minimum(ix + 1, w - 1)
+    iy1 = minimum(iy + 1, h - 1)
+    dx = clip(fx - ix, 0, 1)
+    dy = clip(fy - iy, 0, 1)
+
+    index = asarray([iy * w + ix, iy * w + ix1, iy1 * w + ix, iy1 * w + ix1])
+    weight = asarray([(1 - dx) * (1 - dy), dx * (1 - dy),
+                      (1 - dx) * dy, dx * dy]) * inside
+    return {'tile': (x0, y0, w, h), 'index': index, 'weight': weight}
+
+
+def sample_tile(tile_data, sampler, profile=None):
+    """
+    Interpolate the tile at the coordinates of the sampler.
+
+    Returns a numpy 2d array with the same dtype as tile_data.
+
+    @param tile_data:       2d numpy array of the sampler 'tile'
+    @param sampler:         Dict from line_sampler()
+    @param profile:         'Mean' or 'Max' to reduce the line width to a
+                            single row. See project_row()
+    """
+    flat = tile_data.ravel()
+    values = (flat[sampler['index']] * sampler['weight']).sum(axis=0)
+    return project_row(values, profile, tile_data.dtype)
+
+
+def project_row(row_data, profile, dtype):
+    """
+    Reduce the width of the line to a single row and cast it to dtype.
+
+    Returns a numpy 2d array, a single row if profile is 'Mean' or 'Max'
+    or row_data unchanged otherwise. Integer types are rounded.
+
+    @param row_data:        2d numpy array, line_w rows
+    @param profile:         'Mean', 'Max' or None
+    @param dtype:           numpy dtype of the returned row
+    """
+    if profile == 'Mean':
+        row_data = row_data.mean(axis=0, keepdims=True)
+    elif profile == 'Max':
+        row_data = row_data.max(axis=0, keepdims=True)
+    if issubdtype(dtype, integer) and not issubdtype(row_data.dtype, integer):
+        row_data = rint(row_data)
+    return row_data.astype(dtype)
+
+
+def region_prefetcher(conn, image, requests):
+    """
+    Generator of the raw pixel data of all channels for each request.
+
+    Each request is (the_z, the_t, tile) where tile is (x, y, w, h).
+    Yields 3d numpy arrays of shape (sizeC, h, w) in the order requested.
+    Every channel of a tile is fetched in a single getHypercube() call and
+    consecutive requests for the same Z and tile at the next timepoints are
+    read ahead in the same call, up to MAX_READ_AHEAD timepoints or
+    READ_AHEAD_BYTES.
+
+    @param conn:            BlitzGateway connection
+    @param image:           ImageWrapper object
+    @param requests:        List of (the_z, the_t, tile)
+    """
+    pixels = image.getPrimaryPixels()
+    size_c = image.getSizeC()
+    pixels_type = numpy.dtype(PIXEL_TYPES[pixels.getPixelsType().value])
+    big_endian = pixels_type.newbyteorder('>')
+
+    store = conn.c.sf.createRawPixelsStore()
+    try:
+        store.setPixelsId(pixels.getId(), True, conn.SERVICE_OPTS)
+        start = 0
+        while start < len(requests):
+            the_z, the_t, tile = requests[start]
+            x, y, w, h = tile
+            t_bytes = w * h * size_c * pixels_type.itemsize
+            max_count = min(MAX_READ_AHEAD, READ_AHEAD_BYTES // t_bytes)
+            max_count = max(1, max_count)
+            count = 1
+            while count < max_count and start + count < len(requests) and \
+                    requests[start + count] == (the_z, the_t + count, tile):
+                count += 1
+            data = store.getHypercube([x, y, the_z, 0, the_t],
+                                      [w, h, 1, size_c, count],
+                                      [1, 1, 1, 1, 1])
+            cube = frombuffer(data, dtype=big_endian).astype(pixels_type)
+            cube = cube.reshape(count, size_c, h, w)
+            for i in range(count):
+                yield cube[i]
+            start += count
+    finally:
+        store.close()
+
+
+def new_kymograph_planes(size_c, shape, dtype):
+    """
+    Return a list of size_c zero-filled 2d arrays to write kymograph rows to.
+
+    If the planes would need more than MEMMAP_BYTES they are memory-mapped
+    to temporary files instead of held in memory.
+    """
+    plane_bytes = shape[0] * shape[1] * numpy.dtype(dtype).itemsize
+    if plane_bytes * size_c <= MEMMAP_BYTES:
+        return [zeros(shape, dtype=dtype) for the_c in range(size_c)]
+    return [numpy.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+',
+                         shape=shape) for the_c in range(size_c)]
+
+
+def get_kymograph_planes(conn, script_params, image, t_shapes, row_length,
+                         line_width, get_sampler, get_rendered_row):
+    """
+    Get the kymograph plane for every channel.
+
+    Each plane has line_width rows (or a single row if there is a 'Profile')
+    for each (the_t, shape) in t_shapes and is row_length wide. Rows are
+    written in place into planes allocated up front, cropped or padded with
+    zeros to row_length. Raw pixel data is sampled from tiles fetched by
+    region_prefetcher(), so each tile is downloaded once for all channels.
+
+    @param t_shapes:            List of (the_t, shape)
+    @param row_length:          Width of the kymograph
+    @param get_sampler:         Function returning the sampler for a shape
+    @param get_rendered_row:    Function(shape, the_c, the_t) using
+                                get_line_data()
+    """
+    size_c = image.getSizeC()
+    raw_pixels = use_raw_pixels(script_params)
+    profile = get_profile(script_params)
+    row_height = get_row_height(script_params, line_width)
+    if raw_pixels:
+        pixels_type = image.getPrimaryPixels().getPixelsType().value
+        dtype = PIXEL_TYPES[pixels_type]
+    else:
+        dtype = numpy.uint8     # get_line_data() returns 8-bit data
+    plane_shape = (len(t_shapes) * row_height, row_length)
+    planes = new_kymograph_planes(size_c, plane_shape, dtype)
+
+    def write_row(plane, index, row_data):
+        length = min(row_data.shape[1], row_length)
+        y = index * row_height
+        plane[y:y + row_height, :length] = row_data[:, :length]
+
+    if not raw_pixels:
+        for the_c in range(size_c):
+            for index, (the_t, shape) in enumerate(t_shapes):
+                row_data = get_rendered_row(shape, the_c, the_t)
+                row_data = project_row(row_data, profile, dtype)
+                write_row(planes[the_c], index, row_data)
+        return planes
+
+    samplers = [get_sampler(shape) for the_t, shape in t_shapes]
+    requests = [(shape['theZ'], the_t, sampler['tile']) for
+                (the_t, shape), sampler in zip(t_shapes, samplers)]
+    tiles = region_prefetcher(conn, image, requests)
+    for index, (sampler, tile_data) in enumerate(zip(samplers, tiles)):
+        for the_c in range(size_c):
+            row_data = sample_tile(tile_data[the_c], sampler, profile)
+            write_row(planes[the_c], index, row_data)
+    return planes
 
-    first_list = point_lists[1]
-    xy_list = []
-    for xy in first_list.strip(" []").split(", "):
-        x, y = xy.split(",")
-        xy_list.append((float(x.strip()), float(y.strip())))
-    return xy_list
+
+def get_timepoint_shapes(shapes, size_t, use_all_times):
+    """
+    Return the list of (the_t, shape) to use for each row of a kymograph.
+
+    @param shapes:          map of theT: shape
+    """
+    t_shapes = []
+    shape = shapes[min(shapes)]     # use the first shape until updated
+    for the_t in range(size_t):
+        if the_t in shapes:
+            shape = shapes[the_t]
+        elif not use_all_times:
+            continue
+        t_shapes.append((the_t, shape))
+    return t_shapes
+
+
+def use_raw_pixels(script_params):
+    """Return True unless script_params ask for rendered (8-bit) data."""
+    return script_params.get('Sampling', 'Raw') == 'Raw'
+
+
+def get_profile(script_params):
+    """Return 'Mean' or 'Max' if script_params ask for a line profile."""
+    profile = script_params.get('Profile')
+    return profile if profile in ('Mean', 'Max') else None
+
+
+def get_row_height(script_params, line_width):
+    """Return the number of kymograph rows for each timepoint."""
+    return 1 if get_profile(script_params) else line_width
+
+
+def get_row_description(script_params, line_width):
+    """Describe the kymograph rows for the description of new images."""
+    profile = get_profile(script_params)
+    if profile is None:
+        return "\nwith each timepoint being %s vertical pixels" % line_width
+    return "\nwith each timepoint being 1 vertical pixel, the %s of a" \
+        " line %s pixels wide" % (profile.lower(), line_width)
 
 
 def polyline_kymograph(conn, script_params, image, polylines, line_width,
@@ -189,46 +517,44 @@ def polyline_kymograph(conn, script_params, image, polylines, line_width,
             first_shape = polylines[t]
             break
 
+    samplers = {}       # reuse sampling grids for every C and T
+
+    def get_sampler(shape):
+        key = tuple(shape['points'])
+        if key not in samplers:
+            xs, ys = polyline_sampling_grid(shape['points'], line_width)
+            samplers[key] = line_sampler(image, xs, ys)
+        return samplers[key]
+
+    def get_rendered_row(shape, the_c, the_t):
+        line_data = []
+        points = shape['points']
+        the_z = shape['theZ']
+        for point in range(len(points)-1):
+            x1, y1 = points[point]
+            x2, y2 = points[point+1]
+            ld = get_line_data(image, x1, y1, x2, y2,
+                               line_width, the_z, the_c, the_t)
+            line_data.append(ld)
+        return hstack(line_data)
+
     def plane_gen():
         """Final image is single Z and T. Each plane is rows of T-slices."""
-        for the_c in range(size_c):
-            shape = first_shape
-            t_rows = []
-            for the_t in range(size_t):
-                # update shape if specified for this timepoint
-                if the_t in polylines:
-                    shape = polylines[the_t]
-                elif not use_all_times:
-                    continue
-                line_data = []
-                points = shape['points']
-                the_z = shape['theZ']
-                for point in range(len(points)-1):
-                    x1, y1 = points[point]
-                    x2, y2 = points[point+1]
-                    ld = get_line_data(image, x1, y1, x2, y2,
-                                       line_width, the_z, the_c, the_t)
-                    line_data.append(ld)
-                row_data = hstack(line_data)
-                t_rows.append(row_data)
-
-            # have to handle any mismatch in line lengths by padding shorter
-            # rows
-            longest = max([row_array.shape[1] for row_array in t_rows])
-            for t in range(len(t_rows)):
-                t_row = t_rows[t]
-                row_height, row_length = t_row.shape
-                if row_length < longest:
-                    padding = longest - row_length
-                    pad_data = zeros((row_height, padding), dtype=t_row.dtype)
-                    t_rows[t] = hstack([t_row, pad_data])
-            c_data = vstack(t_rows)
+        t_shapes = get_timepoint_shapes(polylines, size_t, use_all_times)
+        # have to handle any mismatch in line lengths by padding shorter
+        # rows
+        longest = max([polyline_length(shape['points'])
+                       for the_t, shape in t_shapes])
+        planes = get_kymograph_planes(conn, script_params, image, t_shapes,
+                                      longest, line_width, get_sampler,
+                                      get_rendered_row)
+        for c_data in planes:
             yield c_data
 
     name = "%s_kymograph" % image.getName()
     desc = "Kymograph generated from Image ID: %s, polyline: %s" \
         % (image.getId(), first_shape['points'])
-    desc += "\nwith each timepoint being %s vertical pixels" % line_width
+    desc += get_row_description(script_params, line_width)
     return conn.createImageFromNumpySeq(
         plane_gen(), name, 1, size_c, 1, description=desc,
         dataset=dataset)
@@ -258,69 +584,321 @@ def lines_kymograph(conn, script_params, image, lines, line_width, dataset):
             first_line = lines[t]
             break
 
+    samplers = {}       # reuse sampling grids for every C and T
+
+    def get_sampler(shape):
+        key = (shape['x1'], shape['y1'], shape['x2'], shape['y2'])
+        if key not in samplers:
+            xs, ys = line_sampling_grid(*key, line_w=line_width)
+            samplers[key] = line_sampler(image, xs, ys)
+        return samplers[key]
+
+    def get_rendered_row(shape, the_c, the_t):
+        x1, y1, x2, y2 = shape['x1'], shape['y1'], shape['x2'], shape['y2']
+        return get_line_data(image, x1, y1, x2, y2, line_width,
+                             shape['theZ'], the_c, the_t)
+
     def plane_gen():
         """Final image is single Z and T. Each plane is rows of T-slices."""
-        for the_c in range(size_c):
-            shape = first_line
-            r_length = None           # set this for first line
-            t_rows = []
-            for the_t in range(size_t):
-                if the_t in lines:
-                    shape = lines[the_t]
-                elif not use_all_times:
-                    continue
-                the_z = shape['theZ']
-                x1, y1, x2, y2 = shape['x1'], shape['y1'], shape['x2'], \
-                    shape['y2']
-                row_data = get_line_data(
-                    image, x1, y1, x2, y2, line_width,
-                    the_z, the_c, the_t)
-                # if the row is too long, crop - if it's too short, pad
-                row_height, row_length = row_data.shape
-                if r_length is None:
-                    r_length = row_length
-                if row_length < r_length:
-                    padding = r_length - row_length
-                    pad_data = zeros((row_height, padding),
-                                     dtype=row_data.dtype)
-                    row_data = hstack([row_data, pad_data])
-                elif row_length > r_length:
-                    row_data = row_data[:, 0:r_length]
-                t_rows.append(row_data)
-            yield vstack(t_rows)
+        t_shapes = get_timepoint_shapes(lines, size_t, use_all_times)
+        # if a row is too long, crop - if it's too short, pad
+        r_length = line_length(first_line['x1'], first_line['y1'],
+                               first_line['x2'], first_line['y2'])
+        planes = get_kymograph_planes(conn, script_params, image, t_shapes,
+                                      r_length, line_width, get_sampler,
+                                      get_rendered_row)
+        for c_data in planes:
+            yield c_data
 
     name = "%s_kymograph" % image.getName()
     desc = "Kymograph generated from Image ID: %s, line: %s" \
         % (image.getId(), first_line)
-    desc += "\nwith each timepoint being %s vertical pixels" % line_width
+    desc += get_row_description(script_params, line_width)
     return conn.createImageFromNumpySeq(
         plane_gen(), name, 1, size_c, 1, description=desc,
         dataset=dataset)
 
 
+def get_roi_shapes(roi):
+    """
+    Return maps of theT: line and theT: polyline for the shapes of the ROI.
+
+    Lines are dicts of theZ, x1, y1, x2, y2 and polylines are dicts of theZ
+    and points, so they can be used by any connection.
+    """
+    lines = {}          # map of theT: line
+    polylines = {}      # map of theT: polyline
+    for s in roi.copyShapes():
+        if s is None:
+            continue
+        the_t = unwrap(s.getTheT())
+        the_z = unwrap(s.getTheZ())
+        z = 0
+        t = 0
+        if the_t is not None:
+            t = the_t
+        if the_z is not None:
+            z = the_z
+        # TODO: Add some filter of shapes. E.g. text? / 'lines' only
+        # etc.
+        if type(s) == omero.model.LineI:
+            x1 = s.getX1().getValue()
+            x2 = s.getX2().getValue()
+            y1 = s.getY1().getValue()
+            y2 = s.getY2().getValue()
+            lines[t] = {'theZ': z, 'x1': x1, 'y1': y1, 'x2': x2,
+                        'y2': y2}
+
+        elif type(s) == omero.model.PolylineI:
+            v = s.getPoints().getValue()
+            points = points_string_to_xy_list(v)
+            polylines[t] = {'theZ': z, 'points': points}
+    return lines, polylines
+
+
+def roi_fingerprint(image_id, roi, script_params):
+    """
+    Return a hash of everything that the kymograph for an ROI depends on.
+
+    This covers the ID, type, version, update event, Z, T and coordinates
+    of each shape and the FINGERPRINT_PARAMS of the script.
+    """
+    values = [image_id, roi.getId().getValue()]
+    values.extend([(name, script_params.get(name))
+                   for name in FINGERPRINT_PARAMS])
+    shapes = [s for s in roi.copyShapes() if s is not None]
+    for s in sorted(shapes, key=lambda s: s.getId().getValue()):
+        update_event = None
+        if s.getDetails() is not None and \
+                s.getDetails().getUpdateEvent() is not None:
+            update_event = s.getDetails().getUpdateEvent().getId()
+        values.append((s.getId().getValue(), s.__class__.__name__,
+                       unwrap(s.getVersion()), unwrap(update_event),
+                       unwrap(s.getTheZ()), unwrap(s.getTheT())))
+        if type(s) == omero.model.LineI:
+            values.append((s.getX1().getValue(), s.getY1().getValue(),
+                           s.getX2().getValue(), s.getY2().getValue()))
+        elif type(s) == omero.model.PolylineI:
+            values.append(s.getPoints().getValue())
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def find_kymographs(conn, fingerprints):
+    """
+    Find kymographs created by this script from unchanged ROIs.
+
+    Returns a dict of fingerprint: Image ID for kymographs that have a
+    KYMOGRAPH_NS map annotation with one of the fingerprints.
+    """
+    if len(fingerprints) == 0:
+        return {}
+    params = omero.sys.ParametersI()
+    params.addString("ns", KYMOGRAPH_NS)
+    params.addString("key", "Fingerprint")
+    params.add("fingerprints", rlist([rstring(f) for f in fingerprints]))
+    query = """select mv.value, link.parent.id from ImageAnnotationLink link
+        join link.child as ann join ann.mapValue as mv
+        where ann.ns = :ns and mv.name = :key
+        and mv.value in (:fingerprints)"""
+    rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    return dict([(unwrap(row[0]), unwrap(row[1])) for row in rows])
+
+
+def create_kymograph(conn, script_params, image_id, roi_id, fingerprint,
+                     lines, polylines, line_width, dataset):
+    """
+    Create a kymograph for the lines or polylines of one ROI.
+
+    The image is loaded with conn, so this can be called from any worker.
+    The ROI fingerprint is saved on the new image as a map annotation, so
+    the kymograph can be reused if the ROI doesn't change.
+    Returns the ID of the new image.
+    """
+    image = conn.getObject("Image", image_id)
+    if len(lines) > 0:
+        new_img = lines_kymograph(
+            conn, script_params, image, lines, line_width, dataset)
+    else:
+        new_img = polyline_kymograph(
+            conn, script_params, image, polylines, line_width, dataset)
+
+    map_ann = MapAnnotationWrapper(conn)
+    # Use custom namespace to allow finding the kymographs we create
+    map_ann.setNs(KYMOGRAPH_NS)
+    map_ann.setValue([["Source_Image_ID", str(image_id)],
+                      ["ROI_ID", str(roi_id)],
+                      ["Fingerprint", fingerprint]])
+    map_ann.save()
+    new_img.linkAnnotation(map_ann)
+    return new_img.getId()
+
+
+def join_session(conn):
+    """Return a new BlitzGateway connection to the same session as conn."""
+    client = omero.client(pmap=conn.c.getPropertyMap())
+    client.joinSession(conn.c.getSessionId())
+    worker_conn = BlitzGateway(client_obj=client)
+    worker_conn.SERVICE_OPTS.setOmeroGroup(conn.SERVICE_OPTS.getOmeroGroup())
+    return worker_conn
+
+
+def run_tasks(conn, func, tasks, workers=1):
+    """
+    Call func(conn, *task) for each task and return results in task order.
+
+    If workers > 1, tasks run in a pool of up to that many threads (capped
+    at MAX_WORKERS), each with its own connection joined to the session of
+    conn. Joined connections are closed without killing the session.
+    """
+    workers = min(workers, MAX_WORKERS, len(tasks))
+    if workers <= 1:
+        return [func(conn, *task) for task in tasks]
+
+    local = threading.local()
+    worker_conns = []
+    lock = threading.Lock()
+
+    def call(task):
+        worker_conn = getattr(local, 'conn', None)
+        if worker_conn is None:
+            worker_conn = join_session(conn)
+            local.conn = worker_conn
+            with lock:
+                worker_conns.append(worker_conn)
+        return func(worker_conn, *task)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(call, tasks))
+    finally:
+        for worker_conn in worker_conns:
+            worker_conn.close(hard=False)
+
+
+def save_kymograph_metadata(conn, metadata):
+    """
+    Set channel names, colors and pixel sizes of new kymographs.
+
+    All Pixels, Channels and LogicalChannels are loaded in one query and
+    saved in one call, then rendering settings are reset based on the new
+    colors for all the images together.
+
+    @param metadata:    Dict of new Image ID: dict of 'names' and 'colors'
+                        per channel, 'pixel_size' and 't_per_pixel'
+    """
+    if len(metadata) == 0:
+        return
+    image_ids = list(metadata.keys())
+    params = omero.sys.ParametersI()
+    params.addIds(image_ids)
+    query = """select distinct p from Pixels p
+        join fetch p.channels as c join fetch c.logicalChannel
+        where p.image.id in (:ids)"""
+    query_service = conn.getQueryService()
+    all_pixels = query_service.findAllByQuery(query, params, conn.SERVICE_OPTS)
+
+    microm = getattr(omero.model.enums.UnitsLength, "MICROMETER")
+    for px in all_pixels:
+        image_metadata = metadata[px.getImage().getId().getValue()]
+        for i, c_obj in enumerate(px.copyChannels()):
+            c_obj.getLogicalChannel().setName(
+                rstring(image_metadata['names'][i]))
+            r, g, b = image_metadata['colors'][i]
+            c_obj.red = omero.rtypes.rint(r)
+            c_obj.green = omero.rtypes.rint(g)
+            c_obj.blue = omero.rtypes.rint(b)
+            c_obj.alpha = omero.rtypes.rint(255)
+
+        # If we know pixel sizes, set them on the new image
+        if image_metadata['pixel_size'] is not None:
+            px.setPhysicalSizeX(omero.model.LengthI(
+                image_metadata['pixel_size'], microm))
+        if image_metadata['t_per_pixel'] is not None:
+            px.setPhysicalSizeY(omero.model.LengthI(
+                image_metadata['t_per_pixel'], microm))
+    conn.getUpdateService().saveArray(all_pixels, conn.SERVICE_OPTS)
+
+    # reset based on colors above
+    conn.getRenderingSettingsService().resetDefaultsInSet(
+        "Image", image_ids, conn.SERVICE_OPTS)
+
+
 def process_images(conn, script_params):
-    """Process each image passed to script, generating new Kymograph images."""
+    """
+    Process each image passed to script, generating new Kymograph images.
+
+    Returns the new kymographs, the kymographs reused for unchanged ROIs
+    and a message, or None, None and a message if there is nothing to
+    process.
+    """
     line_width = script_params['Line_Width']
-    new_kymographs = []
+    workers = script_params.get('Workers', 1)
     message = ""
 
     # Get the images
     images, log_message = script_utils.get_objects(conn, script_params)
     message += log_message
     if not images:
-        return None, message
+        return None, None, message
 
     # Check for line and polyline ROIs and filter images list
     images = [image for image in images if
               image.getROICount(["Polyline", "Line"]) > 0]
     if not images:
         message += "No ROI containing line or polyline was found."
-        return None, message
+        return None, None, message
+
+    # kymograph strategy - Using Line and Polyline ROIs:
+    # NB: Use ALL time points unless >1 shape AND 'use_all_timepoints' =
+    # False
+    # If > 1 shape per time-point (per ROI), pick one!
+    # 1 - Single line. Use this shape for all time points
+    # 2 - Many lines. Use the first one to fix length. Subsequent lines to
+    # update start and direction
+    # 3 - Single polyline. Use this shape for all time points
+    # 4 - Many polylines. Use the first one to fix length.
+    images = [image for image in images if image.getSizeT() > 1]
+    datasets = []
+    tasks = []          # one kymograph per task, in image and ROI order
+    task_images = []    # index of the image for each task
+    roi_service = conn.getRoiService()
+    for index, image in enumerate(images):
+        dataset = image.getParent()
+        if dataset is not None and not dataset.canLink():
+            dataset = None
+        datasets.append(dataset)
 
-    for image in images:
-        if image.getSizeT() == 1:
+        result = roi_service.findByImage(image.getId(), None)
+        for roi in result.rois:
+            lines, polylines = get_roi_shapes(roi)
+            if len(lines) > 0 or len(polylines) > 0:
+                fingerprint = roi_fingerprint(image.getId(), roi,
+                                              script_params)
+                tasks.append((script_params, image.getId(), roi.getId().val,
+                              fingerprint, lines, polylines, line_width,
+                              dataset))
+                task_images.append(index)
+
+    # Skip ROIs that are unchanged since their kymograph was created
+    existing = {}
+    if script_params.get('Reuse_Unchanged', True):
+        existing = find_kymographs(conn, [task[3] for task in tasks])
+    new_tasks = [task for task in tasks if task[3] not in existing]
+    reused_ids = [existing[task[3]] for task in tasks if task[3] in existing]
+    created_ids = iter(run_tasks(conn, create_kymograph, new_tasks, workers))
+    new_image_ids = [None if task[3] in existing else next(created_ids)
+                     for task in tasks]
+
+    metadata = {}       # new Image ID: channels and pixel sizes to save
+    dataset = None
+    for index, image in enumerate(images):
+        # kymographs derived from the current image.
+        new_images = [new_id for new_id, img_index
+                      in zip(new_image_ids, task_images)
+                      if img_index == index and new_id is not None]
+        dataset = datasets[index]
+        if len(new_images) == 0:
             continue
-        new_images = []      # kymographs derived from the current image.
         c_names = []
         colors = []
         for ch in image.getChannels():
@@ -330,61 +908,6 @@ def process_images(conn, script_params):
         size_t = image.getSizeT()
         pixels = image.getPrimaryPixels()
 
-        dataset = image.getParent()
-        if dataset is not None and not dataset.canLink():
-            dataset = None
-
-        roi_service = conn.getRoiService()
-        result = roi_service.findByImage(image.getId(), None)
-
-        # kymograph strategy - Using Line and Polyline ROIs:
-        # NB: Use ALL time points unless >1 shape AND 'use_all_timepoints' =
-        # False
-        # If > 1 shape per time-point (per ROI), pick one!
-        # 1 - Single line. Use this shape for all time points
-        # 2 - Many lines. Use the first one to fix length. Subsequent lines to
-        # update start and direction
-        # 3 - Single polyline. Use this shape for all time points
-        # 4 - Many polylines. Use the first one to fix length.
-        for roi in result.rois:
-            lines = {}          # map of theT: line
-            polylines = {}      # map of theT: polyline
-            for s in roi.copyShapes():
-                if s is None:
-                    continue
-                the_t = unwrap(s.getTheT())
-                the_z = unwrap(s.getTheZ())
-                z = 0
-                t = 0
-                if the_t is not None:
-                    t = the_t
-                if the_z is not None:
-                    z = the_z
-                # TODO: Add some filter of shapes. E.g. text? / 'lines' only
-                # etc.
-                if type(s) == omero.model.LineI:
-                    x1 = s.getX1().getValue()
-                    x2 = s.getX2().getValue()
-                    y1 = s.getY1().getValue()
-                    y2 = s.getY2().getValue()
-                    lines[t] = {'theZ': z, 'x1': x1, 'y1': y1, 'x2': x2,
-                                'y2': y2}
-
-                elif type(s) == omero.model.PolylineI:
-                    v = s.getPoints().getValue()
-                    points = points_string_to_xy_list(v)
-                    polylines[t] = {'theZ': z, 'points': points}
-
-            if len(lines) > 0:
-                new_img = lines_kymograph(
-                    conn, script_params, image, lines, line_width, dataset)
-                new_images.append(new_img)
-                lines = []
-            elif len(polylines) > 0:
-                new_img = polyline_kymograph(
-                    conn, script_params, image, polylines, line_width, dataset)
-                new_images.append(new_img)
-
         # look-up the interval for each time-point
         t_interval = None
         infos = list(pixels.copyPlaneInfo(theC=0, theT=size_t-1, theZ=0))
@@ -405,52 +928,56 @@ def process_images(conn, script_params):
         elif "Pixel_Size" in script_params:
             pixel_size = script_params['Pixel_Size']
 
-        # Save channel names and colors for each new image
-        for img in new_images:
-            for i, c in enumerate(img.getChannels()):
-                lc = c.getLogicalChannel()
-                lc.setName(c_names[i])
-                lc.save()
-                r, g, b = colors[i]
-                # need to reload channels to avoid optimistic lock on update
-                c_obj = conn.getQueryService().get("Channel", c.id)
-                c_obj.red = omero.rtypes.rint(r)
-                c_obj.green = omero.rtypes.rint(g)
-                c_obj.blue = omero.rtypes.rint(b)
-                c_obj.alpha = omero.rtypes.rint(255)
-                conn.getUpdateService().saveObject(c_obj)
-            img.resetRDefs()  # reset based on colors above
-
-            # If we know pixel sizes, set them on the new image
-            if pixel_size is not None or t_interval is not None:
-                px = conn.getQueryService().get("Pixels", img.getPixelsId())
-                microm = getattr(omero.model.enums.UnitsLength, "MICROMETER")
-                if pixel_size is not None:
-                    pixel_size = omero.model.LengthI(pixel_size, microm)
-                    px.setPhysicalSizeX(pixel_size)
-                if t_interval is not None:
-                    t_per_pixel = t_interval / line_width
-                    t_per_pixel = omero.model.LengthI(t_per_pixel, microm)
-                    px.setPhysicalSizeY(t_per_pixel)
-                conn.getUpdateService().saveObject(px)
-        new_kymographs.extend(new_images)
-
-    if not new_kymographs:
+        t_per_pixel = None
+        if t_interval is not None:
+            t_per_pixel = t_interval / get_row_height(script_params,
+                                                      line_width)
+        for new_id in new_images:
+            metadata[new_id] = {'names': c_names, 'colors': colors,
+                                'pixel_size': pixel_size,
+                                't_per_pixel': t_per_pixel}
+
+    # Save channel names, colors and pixel sizes for all new images
+    new_ids = [new_id for new_id in new_image_ids if new_id is not None]
+    for i in range(0, len(new_ids), METADATA_BATCH):
+        batch_ids = new_ids[i:i + METADATA_BATCH]
+        save_kymograph_metadata(
+            conn, dict([(new_id, metadata[new_id]) for new_id in batch_ids]))
+    new_kymographs = []
+    if len(new_ids) > 0:
+        loaded = dict([(img.getId(), img) for img in
+                       conn.getObjects("Image", new_ids)])
+        new_kymographs = [loaded[new_id] for new_id in new_ids]
+
+    reused_kymographs = []
+    if len(reused_ids) > 0:
+        loaded = dict([(img.getId(), img) for img in
+                       conn.getObjects("Image", reused_ids)])
+        reused_kymographs = [loaded[reused_id] for reused_id in reused_ids
+                             if reused_id in loaded]
+
+    if len(reused_kymographs) == 1:
+        message += "Kymograph of unchanged ROI reused: %s. " \
+            % reused_kymographs[0].getName()
+    elif len(reused_kymographs) > 1:
+        message += "%s kymographs of unchanged ROIs reused. " \
+            % len(reused_kymographs)
+    if not new_kymographs and not reused_kymographs:
         message += "No kymograph created. See 'Error' or 'Info' for details."
-    else:
+    elif new_kymographs:
         if not dataset:
             link_message = " but could not be attached"
         else:
             link_message = ""
 
-        if len(new_images) == 1:
+        if len(new_kymographs) == 1:
             message += "New kymograph created%s: %s." \
-                % (link_message, new_images[0].getName())
-        elif len(new_images) > 1:
+                % (link_message, new_kymographs[0].getName())
+        elif len(new_kymographs) > 1:
             message += "%s new kymographs created%s." \
-                % (len(new_images), link_message)
+                % (len(new_kymographs), link_message)
 
-    return new_kymographs, message
+    return new_kymographs, reused_kymographs, message
 
 
 def run_script():
@@ -481,11 +1008,33 @@ same sizeC as input.""",
             "Line_Width", optional=False, grouping="3", default=4,
             description="Width in pixels of each time slice", min=1),
 
+        scripts.String(
+            "Profile", grouping="3.1", default="Full_Width",
+            description="Keep every row of the line width, or reduce each"
+            " timepoint to a single row with the 'Mean' or 'Max' across the"
+            " line", values=[rstring('Full_Width'), rstring('Mean'),
+                             rstring('Max')]),
+
         scripts.Bool(
             "Use_All_Timepoints", grouping="4", default=True,
             description="Use every timepoint in the kymograph. If False, only"
             " use timepoints with ROI-shapes"),
 
+        scripts.String(
+            "Sampling", grouping="4.1", default="Raw",
+            description="Sample 'Raw' pixel data (keeps the pixel type) or"
+            " 'Rendered' 8-bit data using the current rendering settings",
+            values=[rstring('Raw'), rstring('Rendered')]),
+
+        scripts.Int(
+            "Workers", grouping="4.2", default=1, min=1, max=MAX_WORKERS,
+            description="Number of sessions creating kymographs in parallel"),
+
+        scripts.Bool(
+            "Reuse_Unchanged", grouping="4.3", default=True,
+            description="Don't create a new kymograph for ROIs that haven't"
+            " changed since their last kymograph was created"),
+
         scripts.Float(
             "Time_Increment", grouping="5",
             description="If source movie has no time info, specify increment"
@@ -508,7 +1057,8 @@ same sizeC as input.""",
         # wrap client to use the Blitz Gateway
         conn = BlitzGateway(client_obj=client)
 
-        new_images, message = process_images(conn, script_params)
+        new_images, reused_images, message = process_images(conn,
+                                                            script_params)
 
         if new_images:
             if len(new_images) == 1:
@@ -516,6 +1066,14 @@ same sizeC as input.""",
             elif len(new_images) > 1:
                 # return the first one
                 client.setOutput("First_Image", robject(new_images[0]._obj))
+        if reused_images:
+            if len(reused_images) == 1:
+                client.setOutput("Reused_Image",
+                                 robject(reused_images[0]._obj))
+            elif len(reused_images) > 1:
+                # return the first one
+                client.setOutput("First_Reused_Image",
+                                 robject(reused_images[0]._obj))
         client.setOutput("Message", rstring(message))
 
     finally:
@@ -28,165 +28,482 @@ kymograph images that have been created by the 'Kymograph.py' Script.
 @since 3.0
 """
 
-from omero.gateway import BlitzGateway
+from omero.gateway import BlitzGateway, FileAnnotationWrapper
 import omero
-from omero.rtypes import rlong, rstring, robject
-from omero.model import ImageAnnotationLinkI, ImageI
+from omero.rtypes import rlong, rstring, robject, unwrap
+from omero.model import ImageAnnotationLinkI, ImageI, OriginalFileI
+from omero.grid import DoubleColumn, ImageColumn, LongColumn, StringColumn
+from omero.constants.namespaces import NSBULKANNOTATIONS
 import omero.scripts as scripts
 import omero.util.script_utils as script_utils
 import logging
+from collections import OrderedDict
+import numpy
+from scipy import ndimage
 
 logger = logging.getLogger('kymograph_analysis')
 
+# Ridge pixels are this many standard deviations above the mean ridge
+RIDGE_THRESHOLD_SD = 2.0
+# ...and at least this many times the pixel noise / sigma, well above the
+# strongest ridges of white noise, so that noise alone has no tracks
+RIDGE_MIN_SNR = 1.5
+# Number of ridge pixels voting at once in the Hough transform
+HOUGH_CHUNK = 10000
+
+# Number of images to load shapes and pixels for in one query
+ID_BATCH = 500
+# Maximum number of shapes loaded by one query
+SHAPE_PAGE = 10000
+
+# Measurement columns of the OMERO.table and CSV, with descriptions
+COLUMNS = OrderedDict([
+    ("t_start", "t_start (pixels)"),
+    ("x_start", "x_start (pixels)"),
+    ("t_end", "t_end (pixels)"),
+    ("x_end", "x_end (pixels)"),
+    ("dt", "dt (pixels)"),
+    ("dx", "dx (pixels)"),
+    ("x_per_t", "x/t"),
+    ("speed", "speed(um/sec)"),
+    ("avg_x_per_t", "avg x/t"),
+    ("avg_speed", "avg speed(um/sec)")])
+
+
+def ridge_filter(plane, sigma=2.0):
+    """
+    Return the strength of bright ridges (tracks) at every pixel of plane.
+
+    Uses the most negative eigenvalue of the Hessian of the plane smoothed
+    with a Gaussian of sigma, normalised by sigma squared.
+    """
+    plane = numpy.asarray(plane, dtype=numpy.float64)
+    hxx = ndimage.gaussian_filter(plane, sigma, order=(0, 2))
+    hyy = ndimage.gaussian_filter(plane, sigma, order=(2, 0))
+    hxy = ndimage.gaussian_filter(plane, sigma, order=(1, 1))
+    root = numpy.sqrt((hxx - hyy) ** 2 + 4 * hxy ** 2)
+    smallest = (hxx + hyy - root) / 2
+    return numpy.clip(-smallest, 0, None) * sigma ** 2
+
+
+def noise_sd(plane):
+    """Estimate the standard deviation of pixel noise from x differences."""
+    diffs = numpy.diff(numpy.asarray(plane, dtype=numpy.float64), axis=1)
+    return 1.4826 * numpy.median(numpy.abs(diffs)) / numpy.sqrt(2)
+
+
+def ridge_points(plane, sigma=2.0, threshold_sd=RIDGE_THRESHOLD_SD,
+                 min_snr=RIDGE_MIN_SNR):
+    """
+    Return (xs, ys) of the centre pixels of ridges in plane.
+
+    Ridges are thresholded at threshold_sd standard deviations above the
+    mean ridge strength, and at min_snr times the noise of plane divided
+    by sigma (as the ridge strength of white noise is), then thinned to
+    local maxima along x. Pixels within 2 sigma of the left and right
+    edges are dropped, as reflecting the plane makes ridges there.
+    """
+    ridge = ridge_filter(plane, sigma)
+    threshold = max(ridge.mean() + threshold_sd * ridge.std(),
+                    min_snr * noise_sd(plane) / sigma)
+    local_max = ridge == ndimage.maximum_filter1d(ridge, 3, axis=1)
+    is_ridge = (ridge > threshold) & local_max
+    border = int(numpy.ceil(2 * sigma))
+    is_ridge[:, :border] = False
+    is_ridge[:, max(ridge.shape[1] - border, 0):] = False
+    ys, xs = numpy.nonzero(is_ridge)
+    return xs, ys
+
+
+def hough_accumulator(xs, ys, angles, size_x, size_y):
+    """
+    Count the points on every line x.cos(a) + y.sin(a) = rho.
 
-def points_string_to_xy_list(string):
+    Returns the (rho, angle) accumulator and the rho offset. Points are
+    processed in chunks so memory stays bounded for large kymographs.
+    """
+    offset = int(numpy.ceil(numpy.hypot(size_x, size_y)))
+    cos_a = numpy.cos(angles)
+    sin_a = numpy.sin(angles)
+    n_angles = len(angles)
+    n_rho = 2 * offset + 1
+    votes = numpy.zeros(n_rho * n_angles, dtype=numpy.int64)
+    angle_index = numpy.arange(n_angles)
+    for start in range(0, len(xs), HOUGH_CHUNK):
+        x = xs[start:start + HOUGH_CHUNK, numpy.newaxis]
+        y = ys[start:start + HOUGH_CHUNK, numpy.newaxis]
+        rho = numpy.rint(x * cos_a + y * sin_a).astype(numpy.int64) + offset
+        votes += numpy.bincount((rho * n_angles + angle_index).ravel(),
+                                minlength=n_rho * n_angles)
+    return votes.reshape(n_rho, n_angles), offset
+
+
+def detect_tracks(plane, sigma=2.0, min_length=10, max_gap=5,
+                  max_angle=80, max_tracks=200):
     """
-    Convert string to list of (x,y) points.
+    Find straight tracks in a kymograph plane.
+
+    Ridge pixels from ridge_points() vote in a Hough transform over track
+    angles up to max_angle degrees from vertical (stationary). Lines are
+    taken in order of votes, each claiming the ridge pixels within 1.5
+    pixels of it, and split where there is a gap longer than max_gap.
+    Returns a list of (x1, y1, x2, y2) with y1 < y2, for tracks of at
+    least min_length pixels.
+    """
+    size_y, size_x = plane.shape
+    xs, ys = ridge_points(plane, sigma)
+    if len(xs) < min_length:
+        return []
+    angles = numpy.deg2rad(numpy.arange(-max_angle, max_angle + 0.25, 0.5))
+    votes, offset = hough_accumulator(xs, ys, angles, size_x, size_y)
+    peaks = (votes == ndimage.maximum_filter(votes, size=5)) & \
+        (votes >= min_length)
+    rho_index, angle_index = numpy.nonzero(peaks)
+    order = numpy.argsort(-votes[rho_index, angle_index], kind='stable')
+
+    unused = numpy.ones(len(xs), dtype=bool)
+    tracks = []
+    for i in order[:max_tracks]:
+        rho = rho_index[i] - offset
+        cos_a = numpy.cos(angles[angle_index[i]])
+        sin_a = numpy.sin(angles[angle_index[i]])
+        on_line = unused & (numpy.abs(xs * cos_a + ys * sin_a - rho) <= 1.5)
+        if numpy.count_nonzero(on_line) < min_length:
+            continue
+        # position of points along the line, split at gaps
+        along = numpy.sort(ys[on_line] * cos_a - xs[on_line] * sin_a)
+        breaks = numpy.nonzero(numpy.diff(along) > max_gap)[0] + 1
+        for segment in numpy.split(along, breaks):
+            if segment[-1] - segment[0] < min_length:
+                continue
+            ends = [(rho * cos_a - a * sin_a, rho * sin_a + a * cos_a)
+                    for a in (segment[0], segment[-1])]
+            (x1, y1), (x2, y2) = sorted(ends, key=lambda xy: xy[1])
+            tracks.append((x1, y1, x2, y2))
+        unused &= ~on_line
+    return tracks
+
+
+def measure_segments(shapes, microns_per_sec):
+    """
+    Measure every segment of every shape in one vectorized pass.
+
+    Returns a dict of column name: numpy array, one row per segment, for
+    COLUMNS plus 'index', the index in shapes of the shape of each segment.
+    Average x/t and speed are only measured for polylines, relative to
+    their first point, and are NaN for other shapes, as is speed when
+    microns_per_sec is unknown.
+
+    @param shapes:          List of (type, id, xy) where xy is an (N, 2)
+                            array of points, N >= 2
+    @param microns_per_sec: List of microns per second (or None) for each
+                            shape
+    """
+    counts = numpy.array([len(xy) for shape_type, shape_id, xy in shapes],
+                         dtype=numpy.int64)
+    points = numpy.concatenate([xy for shape_type, shape_id, xy in shapes])
+    ends = numpy.cumsum(counts)
+    firsts = ends - counts
+    is_start = numpy.ones(len(points), dtype=bool)
+    is_start[ends - 1] = False      # the last point doesn't start a segment
+    start = numpy.nonzero(is_start)[0]
+    index = numpy.repeat(numpy.arange(len(shapes)), counts - 1)
+
+    x1, y1 = points[start].T
+    x2, y2 = points[start + 1].T
+    x_first, y_first = points[firsts[index]].T
+    um_per_sec = numpy.array([numpy.nan if m is None else m
+                              for m in microns_per_sec])[index]
+    is_polyline = numpy.array([shape_type == "Polyline" for shape_type, i, xy
+                               in shapes], dtype=bool)[index]
+
+    dx = numpy.abs(x1 - x2)
+    dy = numpy.abs(y1 - y2)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        dx_per_y = dx / dy
+        av_x_per_y = numpy.abs((x2 - x_first) / (y2 - y_first))
+    av_x_per_y[~is_polyline] = numpy.nan
+    return {"index": index,
+            "t_start": y1, "x_start": x1, "t_end": y2, "x_end": x2,
+            "dt": dy, "dx": dx, "x_per_t": dx_per_y,
+            "speed": dx_per_y * um_per_sec,
+            "avg_x_per_t": av_x_per_y,
+            "avg_speed": av_x_per_y * um_per_sec}
+
+
+def csv_value(value):
+    """Format a measurement for the CSV, leaving NaN cells empty."""
+    return "" if numpy.isnan(value) else repr(float(value))
+
+
+def write_csv(images, image_info, shapes, measurements, file_name):
+    """
+    Write measurements to a CSV file, with a block of rows for each image.
+
+    Each shape has a 'Line ID:', 'Polyline ID:' or 'Track ID:' row
+    followed by a row for each of its segments.
+    """
+    col_names = "t_start (pixels), x_start (pixels), t_end (pixels)," \
+        " x_end (pixels), dt (pixels), dx (pixels), x/t, speed(um/sec)," \
+        "avg x/t, avg speed(um/sec)"
+    values = numpy.column_stack([measurements[c] for c in COLUMNS]).tolist()
+    index = measurements["index"].tolist()
+    csv_data = []
+    row = 0         # segments are ordered by shape, shapes by image
+    for image in images:
+        info = image_info[image.getId()]
+        if len(info["shapes"]) == 0:
+            continue
+        secs_per_pixel_y, microns_per_pixel_x = info["pixel_sizes"]
+        lines = ["Image ID:, %s,Name:, %s" % (image.getId(), image.getName()),
+                 "secsPerPixelY: %s" % secs_per_pixel_y,
+                 "micronsPerPixelX: %s" % microns_per_pixel_x,
+                 "", col_names]
+        last_shape = None
+        while row < len(index) and index[row] in info["shapes"]:
+            shape_type, shape_id, xy = shapes[index[row]]
+            if index[row] != last_shape:
+                lines.append("%s ID: %s" % (shape_type, shape_id))
+                last_shape = index[row]
+            cells = [csv_value(v) for v in values[row]]
+            if shape_type != "Polyline":
+                cells = cells[:8]
+            lines.append(",".join(cells))
+            row += 1
+        csv_data.append("\n".join(lines))
+
+    with open(file_name, 'w') as csv_file:
+        csv_file.write("\n \n".join(csv_data))
+    return file_name
+
+
+def save_table(conn, shapes, measurements, shape_images):
+    """
+    Save measurements as an OMERO.table, one row per segment.
+
+    Returns a FileAnnotationWrapper of the table.
+    """
+    index = measurements["index"]
+    resources = conn.c.sf.sharedResources()
+    repository_id = resources.repositories().descriptions[0].getId().getValue()
+    table = resources.newTable(repository_id, "kymograph_velocities")
+    try:
+        image_ids = [shape_images[i] for i in index.tolist()]
+        shape_ids = [shapes[i][1] for i in index.tolist()]
+        shape_types = [shapes[i][0] for i in index.tolist()]
+        data = [ImageColumn("Image", "", image_ids),
+                LongColumn("ID", "Shape ID, or number of detected track",
+                           shape_ids),
+                StringColumn("Type", "Line, Polyline or Track", 16,
+                             shape_types)]
+        data.extend([DoubleColumn(c, COLUMNS[c], measurements[c].tolist())
+                     for c in COLUMNS])
+        table.initialize(data)
+        table.addData(data)
+        orig_file = table.getOriginalFile()
+    finally:
+        table.close()
+    file_ann = FileAnnotationWrapper(conn)
+    file_ann.setNs(NSBULKANNOTATIONS)
+    file_ann._obj.file = OriginalFileI(orig_file.id.val, False)
+    file_ann.save()
+    return file_ann
+
+
+def link_to_images(conn, file_ann, image_ids):
+    """Link the file annotation to images in a single call."""
+    links = []
+    for iid in image_ids:
+        link = ImageAnnotationLinkI()
+        link.parent = ImageI(iid, False)
+        link.child = file_ann._obj
+        links.append(link)
+    if len(links) > 0:
+        conn.getUpdateService().saveAndReturnArray(links)
+
+
+def points_string_to_array(string):
+    """
+    Convert string to a float array of (x,y) points, with shape (N, 2).
 
     Expects string in format generated from omero.model.ShapeI.getPoints()
-    e.g. "points[309,427, 366,503]" to [(309,427), (366,503)]
-    """
-    point_lists = string.strip().split("points")
-    if len(point_lists) < 2:
-        if len(point_lists) == 1 and point_lists[0]:
-            xys = point_lists[0].split()
-            xy_list = [tuple(map(float, xy.split(','))) for xy in xys]
-            return xy_list
+    e.g. "points[309,427, 366,503]" or "309,427 366,503".
+    Only the first list of the legacy "points[] points1[] points2[]" format
+    is used.
+    """
+    string = string.strip()
+    if string.startswith("points"):
+        start = string.find("[")
+        end = string.find("]", start)
+        if start < 0 or end < 0:
+            raise ValueError(
+                "Unrecognised ROI shape 'points' string: %s" % string)
+        string = string[start + 1:end]
+    try:
+        coords = numpy.fromstring(string.replace(",", " "),
+                                  dtype=numpy.float64, sep=" ")
+    except ValueError:
+        coords = numpy.empty(0)
+    if coords.size == 0 or coords.size % 2 != 0:
         raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return coords.reshape(-1, 2)
 
-    first_list = point_lists[1]
-    xy_list = []
-    for xy in first_list.strip(" []").split(", "):
-        x, y = xy.split(",")
-        xy_list.append((float(x.strip()), float(y.strip())))
-    return xy_list
+
+def load_kymograph_data(conn, image_ids):
+    """
+    Load the Line and Polyline shapes and pixels of many images in bulk.
+
+    Shapes are loaded with a paged query for up to ID_BATCH images at a
+    time, instead of a ROI lookup per image.
+    Returns a dict of Image ID: list of shapes, ordered by ROI, and a dict
+    of Image ID: Pixels.
+    """
+    query_service = conn.getQueryService()
+    shapes = dict([(iid, []) for iid in image_ids])
+    pixels = {}
+    for start in range(0, len(image_ids), ID_BATCH):
+        ids = image_ids[start:start + ID_BATCH]
+        params = omero.sys.ParametersI()
+        params.addIds(ids)
+        query = "select p from Pixels p where p.image.id in (:ids)"
+        for px in query_service.findAllByQuery(query, params,
+                                               conn.SERVICE_OPTS):
+            pixels[px.getImage().getId().getValue()] = px
+
+        query = """select s, r.image.id from Shape s join s.roi r
+            where r.image.id in (:ids) and s.class in (Line, Polyline)
+            order by r.id, s.id"""
+        offset = 0
+        while True:
+            params.page(offset, SHAPE_PAGE)
+            rows = query_service.projection(query, params, conn.SERVICE_OPTS)
+            for row in rows:
+                shapes[unwrap(row[1])].append(unwrap(row[0]))
+            if len(rows) < SHAPE_PAGE:
+                break
+            offset += SHAPE_PAGE
+    return shapes, pixels
+
+
+def get_length_value(length):
+    """Return the value of an omero.model.Length or None."""
+    return None if length is None else length.getValue()
 
 
 def process_images(conn, script_params):
+    """
+    Measure lines, polylines and detected tracks on kymograph images.
 
-    file_anns = []
+    Returns a dict of script output name: FileAnnotationWrapper for the
+    CSV file ('Line_Data') and OMERO.table ('Table') that were created,
+    and a message.
+    """
+    file_anns = {}
     message = ""
     # Get the images
     images, log_message = script_utils.get_objects(conn, script_params)
     message += log_message
     if not images:
         return None, message
+    detect = script_params.get("Detect_Tracks", False)
+    image_shapes, image_pixels = load_kymograph_data(
+        conn, [image.getId() for image in images])
     # Check for line and polyline ROIs and filter images list
-    images = [image for image in images if
-              image.getROICount(["Polyline", "Line"]) > 0]
+    if not detect:
+        images = [image for image in images if
+                  len(image_shapes[image.getId()]) > 0]
     if not images:
         message += "No ROI containing line or polyline was found."
         return None, message
 
-    csv_data = []
+    shapes = []             # (type, id, xy) for every shape
+    shape_images = []       # Image ID for every shape
+    microns_per_sec = []    # for every shape
+    image_info = {}         # Image ID: shape indexes and pixel sizes
 
     for image in images:
+        pixels = image_pixels[image.getId()]
 
-        if image.getSizeT() > 1:
+        if unwrap(pixels.getSizeT()) > 1:
             message += "%s ID: %s appears to be a time-lapse Image," \
                 " not a kymograph." % (image.getName(), image.getId())
+            image_info[image.getId()] = {"shapes": []}
             continue
 
-        roi_service = conn.getRoiService()
-        result = roi_service.findByImage(image.getId(), None)
-
-        secs_per_pixel_y = image.getPixelSizeY()
-        microns_per_pixel_x = image.getPixelSizeX()
+        secs_per_pixel_y = get_length_value(pixels.getPhysicalSizeY())
+        microns_per_pixel_x = get_length_value(pixels.getPhysicalSizeX())
         if secs_per_pixel_y and microns_per_pixel_x:
-            microns_per_sec = microns_per_pixel_x / secs_per_pixel_y
+            image_microns_per_sec = microns_per_pixel_x / secs_per_pixel_y
         else:
-            microns_per_sec = None
+            image_microns_per_sec = None
 
         # for each line or polyline, create a row in csv table: y(t), x,
         # dy(dt), dx, x/t (line), x/t (average)
-        col_names = "\nt_start (pixels), x_start (pixels), t_end (pixels)," \
-            " x_end (pixels), dt (pixels), dx (pixels), x/t, speed(um/sec)," \
-            "avg x/t, avg speed(um/sec)"
-        table_data = ""
-        for roi in result.rois:
-            for s in roi.copyShapes():
-                if s is None:
-                    continue    # seems possible in some situations
-                if type(s) == omero.model.LineI:
-                    table_data += "\nLine ID: %s" % s.getId().getValue()
-                    x1 = s.getX1().getValue()
-                    x2 = s.getX2().getValue()
-                    y1 = s.getY1().getValue()
-                    y2 = s.getY2().getValue()
-                    dx = abs(x1-x2)
-                    dy = abs(y1-y2)
-                    dx_per_y = float(dx)/dy
-                    speed = ""
-                    if microns_per_sec:
-                        speed = dx_per_y * microns_per_sec
-                    table_data += "\n"
-                    table_data += ",".join(
-                        [str(x) for x in (y1, x1, y2, x2, dy, dx, dx_per_y,
-                                          speed)])
-
-                elif type(s) == omero.model.PolylineI:
-                    table_data += "\nPolyline ID: %s" % s.getId().getValue()
-                    v = s.getPoints().getValue()
-                    points = points_string_to_xy_list(v)
-                    x_start, y_start = points[0]
-                    for i in range(1, len(points)):
-                        x1, y1 = points[i-1]
-                        x2, y2 = points[i]
-                        dx = abs(x1-x2)
-                        dy = abs(y1-y2)
-                        dx_per_y = float(dx)/dy
-                        av_x_per_y = abs(float(x2-x_start)/(y2-y_start))
-                        speed = ""
-                        avg_speed = ""
-                        if microns_per_sec:
-                            speed = dx_per_y * microns_per_sec
-                            avg_speed = av_x_per_y * microns_per_sec
-                        table_data += "\n"
-                        table_data += ",".join(
-                            [str(x) for x in (y1, x1, y2, x2, dy, dx, dx_per_y,
-                                              speed, av_x_per_y, avg_speed)])
-
-        # write table data to csv...
-        if len(table_data) > 0:
-            table_string = "Image ID:, %s," % image.getId()
-            table_string += "Name:, %s" % image.getName()
-            table_string += "\nsecsPerPixelY: %s" % secs_per_pixel_y
-            table_string += '\nmicronsPerPixelX: %s' % microns_per_pixel_x
-            table_string += "\n"
-            table_string += col_names
-            table_string += table_data
-            csv_data.append(table_string)
-
-    iids = [str(i.getId()) for i in images]
-    to_link_csv = [i.getId() for i in images if i.canAnnotate()]
-    csv_file_name = 'kymograph_velocities_%s.csv' % "-".join(iids)
-    with open(csv_file_name, 'w') as csv_file:
-        csv_file.write("\n \n".join(csv_data))
-
-    file_ann = conn.createFileAnnfromLocalFile(csv_file_name,
-                                               mimetype="text/csv")
-    fa_message = "Created Line Plot csv (Excel) file"
-
-    links = []
-    if len(to_link_csv) == 0:
-        fa_message += " but could not attach to images."
-    for iid in to_link_csv:
-        link = ImageAnnotationLinkI()
-        link.parent = ImageI(iid, False)
-        link.child = file_ann._obj
-        links.append(link)
-    if len(links) > 0:
-        links = conn.getUpdateService().saveAndReturnArray(links)
-
-    if file_ann:
-        file_anns.append(file_ann)
+        first_shape = len(shapes)
+        for s in image_shapes[image.getId()]:
+            if type(s) == omero.model.LineI:
+                xy = numpy.array([[s.getX1().getValue(),
+                                   s.getY1().getValue()],
+                                  [s.getX2().getValue(),
+                                   s.getY2().getValue()]])
+                shapes.append(("Line", s.getId().getValue(), xy))
+
+            elif type(s) == omero.model.PolylineI:
+                v = s.getPoints().getValue()
+                xy = points_string_to_array(v)
+                if len(xy) > 1:
+                    shapes.append(("Polyline", s.getId().getValue(), xy))
+
+        if detect:
+            the_c = script_params.get("Detection_Channel", 1) - 1
+            the_c = min(max(the_c, 0), unwrap(pixels.getSizeC()) - 1)
+            plane = image.getPrimaryPixels().getPlane(0, the_c, 0)
+            tracks = detect_tracks(
+                plane, sigma=script_params.get("Ridge_Sigma", 2.0),
+                min_length=script_params.get("Min_Track_Length", 10))
+            for i, (x1, y1, x2, y2) in enumerate(tracks):
+                xy = numpy.array([[x1, y1], [x2, y2]])
+                shapes.append(("Track", i + 1, xy))
+
+        count = len(shapes) - first_shape
+        shape_images.extend([image.getId()] * count)
+        microns_per_sec.extend([image_microns_per_sec] * count)
+        image_info[image.getId()] = {
+            "shapes": range(first_shape, len(shapes)),
+            "pixel_sizes": (secs_per_pixel_y, microns_per_pixel_x)}
+
+    if len(shapes) == 0:
+        message += "No lines, polylines or tracks to measure."
+        return None, message
+    measurements = measure_segments(shapes, microns_per_sec)
+
+    to_link = [i.getId() for i in images if i.canAnnotate()]
+    fa_messages = []
+    if script_params.get("Export_CSV", True):
+        # name by the first image, as all IDs would be too long a name
+        csv_file_name = 'kymograph_velocities_%s.csv' % images[0].getId()
+        if len(images) > 1:
+            csv_file_name = 'kymograph_velocities_%s_%s_images.csv' % (
+                images[0].getId(), len(images))
+        write_csv(images, image_info, shapes, measurements, csv_file_name)
+        file_anns["Line_Data"] = conn.createFileAnnfromLocalFile(
+            csv_file_name, mimetype="text/csv")
+        fa_messages.append("Line Plot csv (Excel) file")
+    if script_params.get("Create_Table", True):
+        file_anns["Table"] = save_table(conn, shapes, measurements,
+                                        shape_images)
+        fa_messages.append("OMERO.table")
+
+    for file_ann in file_anns.values():
+        link_to_images(conn, file_ann, to_link)
 
     if not file_anns:
-        fa_message = "No Analysis files created. See 'Info' or 'Error'" \
+        message += "No Analysis files created. See 'Info' or 'Error'" \
             " for more details"
-    elif len(file_anns) > 1:
-        fa_message = "Created %s csv (Excel) files" % len(file_anns)
-    message += fa_message
+        return None, message
+    message += "Created %s" % " and ".join(fa_messages)
+    if len(to_link) == 0:
+        message += " but could not attach to images."
     return file_anns, message
 
 
@@ -212,6 +529,32 @@ of movement, saved as an Excel / CSV file.""",
             "IDs", optional=False, grouping="2",
             description="List of Image IDs to process.").ofType(rlong(0)),
 
+        scripts.Bool(
+            "Export_CSV", grouping="4", default=True,
+            description="Save speeds as a CSV (Excel) file"),
+
+        scripts.Bool(
+            "Create_Table", grouping="5", default=True,
+            description="Save speeds as an OMERO.table, one row per line"
+            " segment"),
+
+        scripts.Bool(
+            "Detect_Tracks", grouping="3", default=False,
+            description="Also find straight tracks in the kymographs"
+            " automatically, without drawing lines"),
+
+        scripts.Int(
+            "Detection_Channel", grouping="3.1", default=1, min=1,
+            description="Channel to detect tracks in"),
+
+        scripts.Float(
+            "Ridge_Sigma", grouping="3.2", default=2.0, min=0.5,
+            description="Approximate half-width of tracks in pixels"),
+
+        scripts.Int(
+            "Min_Track_Length", grouping="3.3", default=10, min=2,
+            description="Minimum length of detected tracks in pixels"),
+
         version="4.3.3",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
@@ -227,8 +570,8 @@ of movement, saved as an Excel / CSV file.""",
         file_anns, message = process_images(conn, script_params)
 
         if file_anns:
-            if len(file_anns) == 1:
-                client.setOutput("Line_Data", robject(file_anns[0]._obj))
+            for name, file_ann in file_anns.items():
+                client.setOutput(name, robject(file_ann._obj))
         client.setOutput("Message", rstring(message))
 
     finally:
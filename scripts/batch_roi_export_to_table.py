@@ -28,18 +28,65 @@
 """This script exports ROI intensities for selected images."""
 
 
+import omero
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway, MapAnnotationWrapper,\
-    FileAnnotationWrapper
+from omero.gateway import BlitzGateway, FileAnnotationWrapper, \
+    ImageWrapper, ProjectWrapper, ScreenWrapper
 from omero.rtypes import rint, rlong, robject, rstring, unwrap
-from omero.grid import DoubleColumn, ImageColumn
-from omero.model import OriginalFileI
+from omero.api import ShapeStats
+from omero.grid import DoubleColumn, ImageColumn, LongColumn, RoiColumn, \
+    StringColumn
+from omero.model import ImageAnnotationLinkI, ImageI, MapAnnotationI, \
+    NamedValue, OriginalFileI
 from omero.constants.namespaces import NSBULKANNOTATIONS
 
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import fcntl
+import hashlib
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy
 
 DEFAULT_FILE_NAME = "roi_intensities_filtered_by_channel.csv"
 BATCH_ROI_EXPORT_NS = "omero.batch_roi_export.map_ann"
+# Maximum number of shapes to get stats for in one call
+STATS_BATCH_SIZE = 500
+# Maximum bytes of a shape's Z/T stack read in one call, for all planes
+HYPERCUBE_BYTES = 64 * 1024 * 1024
+# Rows formatted at once, bytes buffered before writing and uploaded at once
+CSV_CHUNK_ROWS = 10000
+CSV_BUFFER_SIZE = 1024 * 1024
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+# Rows added to the shape table at once
+TABLE_BATCH_ROWS = 10000
+# Maximum bytes of each string column in the shape table
+TABLE_STRING_SIZES = {"image_name": 256,
+                      "type": 16,
+                      "text": 256,
+                      "intensity_for_channel": 64}
+# Maximum number of sessions exporting images in parallel
+MAX_WORKERS = 8
+# Maximum number of Images to save or delete Key-Value pairs for at once
+MAP_ANN_BATCH = 500
+# Maximum number of Images and of Shapes to query at once
+ID_BATCH = 500
+IMAGE_PAGE = 500
+SHAPE_PAGE = 10000
+# Local directory for checkpoints of unfinished exports
+CHECKPOINT_DIR = os.path.join(tempfile.gettempdir(), "batch_roi_export")
+# Parameters of the export a checkpoint is for, with the user and group
+CHECKPOINT_PARAMS = ["Data_Type", "IDs", "Statistics",
+                     "Intensity_For_Channels", "Export_All_Planes"]
+# Seconds after which checkpoints of abandoned exports are deleted
+CHECKPOINT_MAX_AGE = 7 * 24 * 60 * 60
 
 
 def log(data):
@@ -47,8 +94,524 @@ def log(data):
     print(data)
 
 
-def get_export_data(conn, script_params, image):
-    """Get pixel data for shapes on image and returns list of dicts."""
+def get_shape_stats(roi_service, shape_planes, ch_indexes, batch_size):
+    """
+    Get ShapeStats for each (shape_id, z, t) in shape_planes.
+
+    Shapes on the same plane are grouped, and their stats requested with
+    one getShapeStatsRestricted() call per batch_size shapes. Returns
+    the stats in the same order as shape_planes, None where Z or T is None.
+    """
+    plane_rows = defaultdict(list)
+    for row, (shape_id, z, t) in enumerate(shape_planes):
+        if z is not None and t is not None:
+            plane_rows[(z, t)].append(row)
+
+    all_stats = [None] * len(shape_planes)
+    for (z, t), rows in plane_rows.items():
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            shape_ids = [shape_planes[row][0] for row in batch]
+            stats = roi_service.getShapeStatsRestricted(shape_ids, z, t,
+                                                        ch_indexes)
+            for row, shape_stats in zip(batch, stats):
+                all_stats[row] = shape_stats
+    return all_stats
+
+
+def points_string_to_array(string):
+    """
+    Convert string to a float array of (x,y) points, with shape (N, 2).
+
+    Expects string in format generated from omero.model.ShapeI.getPoints()
+    e.g. "points[309,427, 366,503]" or "309,427 366,503".
+    Only the first list of the legacy "points[] points1[] points2[]" format
+    is used.
+    """
+    string = string.strip()
+    if string.startswith("points"):
+        start = string.find("[")
+        end = string.find("]", start)
+        if start < 0 or end < 0:
+            raise ValueError(
+                "Unrecognised ROI shape 'points' string: %s" % string)
+        string = string[start + 1:end]
+    try:
+        coords = numpy.fromstring(string.replace(",", " "),
+                                  dtype=numpy.float64, sep=" ")
+    except ValueError:
+        coords = numpy.empty(0)
+    if coords.size == 0 or coords.size % 2 != 0:
+        raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return coords.reshape(-1, 2)
+
+
+def get_transform(shape):
+    """Return the shape's affine transform as a 2x3 array, or None."""
+    transform = shape.getTransform() if hasattr(shape, "getTransform") \
+        else None
+    if transform is None:
+        return None
+    return numpy.array([
+        [unwrap(transform.a00), unwrap(transform.a01), unwrap(transform.a02)],
+        [unwrap(transform.a10), unwrap(transform.a11), unwrap(transform.a12)]
+    ], dtype=numpy.float64)
+
+
+def points_in_polygon(xs, ys, vertices):
+    """Even-odd test of each (xs[i], ys[i]) against the polygon vertices."""
+    inside = numpy.zeros(xs.shape, dtype=bool)
+    x0, y0 = vertices[-1]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        for x1, y1 in vertices:
+            crosses = (y1 > ys) != (y0 > ys)
+            x_cross = (x0 - x1) * (ys - y1) / (y0 - y1) + x1
+            inside ^= crosses & (xs < x_cross)
+            x0, y0 = x1, y1
+    return inside
+
+
+def line_pixels(vertices):
+    """Sample the polyline through vertices at least twice per pixel."""
+    xy = [vertices[:1]]
+    for start, end in zip(vertices[:-1], vertices[1:]):
+        steps = int(numpy.ceil(numpy.hypot(*(end - start)) * 2)) + 1
+        xy.append(start + (end - start) * numpy.linspace(
+            0, 1, steps)[:, numpy.newaxis])
+    return numpy.vstack(xy)
+
+
+def rasterize_shape(shape, size_x, size_y):
+    """
+    Return the flat indices of the pixels of a size_y x size_x plane that
+    are inside the shape, sorted and without duplicates.
+
+    A pixel (x, y) is inside an area shape if its integer coordinates are.
+    Points, lines and polylines cover the pixels they pass through.
+    Labels and unsupported shapes cover no pixels.
+    """
+    shape_type = shape.__class__.__name__.rstrip('I').lower()
+    transform = get_transform(shape)
+    empty = numpy.empty(0, dtype=numpy.intp)
+
+    if shape_type in ("point", "line", "polyline"):
+        if shape_type == "point":
+            vertices = numpy.array([[unwrap(shape.x), unwrap(shape.y)]])
+        elif shape_type == "line":
+            vertices = numpy.array([[unwrap(shape.x1), unwrap(shape.y1)],
+                                    [unwrap(shape.x2), unwrap(shape.y2)]])
+        else:
+            vertices = points_string_to_array(unwrap(shape.points))
+        xy = line_pixels(vertices)
+        if transform is not None:
+            xy = xy.dot(transform[:, :2].T) + transform[:, 2]
+        xs, ys = numpy.floor(xy).astype(numpy.intp).T
+        keep = (xs >= 0) & (xs < size_x) & (ys >= 0) & (ys < size_y)
+        return numpy.unique(ys[keep] * size_x + xs[keep])
+
+    if shape_type in ("rectangle", "mask"):
+        x, y = unwrap(shape.x), unwrap(shape.y)
+        w, h = unwrap(shape.width), unwrap(shape.height)
+        corners = numpy.array([[x, y], [x + w, y + h]])
+    elif shape_type == "ellipse":
+        x, y = unwrap(shape.x), unwrap(shape.y)
+        rx, ry = unwrap(shape.radiusX), unwrap(shape.radiusY)
+        corners = numpy.array([[x - rx, y - ry], [x + rx, y + ry]])
+    elif shape_type == "polygon":
+        vertices = points_string_to_array(unwrap(shape.points))
+        corners = vertices
+    else:
+        return empty
+
+    # Bounding box in pixel coordinates, clipped to the plane
+    if transform is not None:
+        (x0, y0), (x1, y1) = corners.min(axis=0), corners.max(axis=0)
+        corners = numpy.array([[x0, y0], [x1, y0], [x0, y1], [x1, y1]])
+        corners = corners.dot(transform[:, :2].T) + transform[:, 2]
+    x_min, y_min = numpy.maximum(numpy.ceil(corners.min(axis=0)), 0)
+    x_max = min(numpy.floor(corners[:, 0].max()), size_x - 1)
+    y_max = min(numpy.floor(corners[:, 1].max()), size_y - 1)
+    if x_max < x_min or y_max < y_min:
+        return empty
+    ys, xs = numpy.mgrid[int(y_min):int(y_max) + 1, int(x_min):int(x_max) + 1]
+    ys, xs = ys.ravel(), xs.ravel()
+
+    # Test pixel coordinates in the shape's own coordinate space
+    sx, sy = xs.astype(numpy.float64), ys.astype(numpy.float64)
+    if transform is not None:
+        inverse = numpy.linalg.inv(numpy.vstack([transform, [0, 0, 1]]))
+        sx, sy = (inverse[:2, :2].dot(numpy.vstack([sx, sy])) +
+                  inverse[:2, 2:])
+
+    if shape_type == "rectangle":
+        inside = (sx >= x) & (sx < x + w) & (sy >= y) & (sy < y + h)
+    elif shape_type == "ellipse":
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            inside = ((sx - x) / rx) ** 2 + ((sy - y) / ry) ** 2 <= 1
+    elif shape_type == "polygon":
+        inside = points_in_polygon(sx, sy, vertices)
+    else:
+        bits = numpy.unpackbits(numpy.frombuffer(shape.getBytes(),
+                                                 dtype=numpy.uint8))
+        bits = bits[:int(w) * int(h)].reshape(int(h), int(w))
+        col = numpy.floor(sx - x).astype(numpy.intp)
+        row = numpy.floor(sy - y).astype(numpy.intp)
+        inside = (col >= 0) & (col < int(w)) & (row >= 0) & (row < int(h))
+        inside[inside] = bits[row[inside], col[inside]].astype(bool)
+    return ys[inside] * size_x + xs[inside]
+
+
+def label_stats(labels, values, count):
+    """
+    Reduce values grouped by labels, sorted from 0 to count - 1.
+
+    Returns arrays of points, min, max, sum, mean and sample standard
+    deviation for each label, 0 where a label has no values.
+    """
+    points = numpy.bincount(labels, minlength=count)
+    sums = numpy.bincount(labels, weights=values, minlength=count)
+    mins = numpy.zeros(count)
+    maxs = numpy.zeros(count)
+    filled = points > 0
+    if filled.any():
+        starts = (numpy.cumsum(points) - points)[filled]
+        mins[filled] = numpy.minimum.reduceat(values, starts)
+        maxs[filled] = numpy.maximum.reduceat(values, starts)
+    means = sums / numpy.maximum(points, 1)
+    # two-pass variance avoids cancellation for large intensities
+    squares = numpy.bincount(labels, weights=(values - means[labels]) ** 2,
+                             minlength=count)
+    std_devs = numpy.sqrt(squares / numpy.maximum(points - 1, 1))
+    return points, mins, maxs, sums, means, std_devs
+
+
+def get_client_shape_stats(image, shape_planes, ch_indexes):
+    """
+    Calculate ShapeStats for each (shape, z, t) in shape_planes locally.
+
+    Each shape is rasterized once, and each (z, c, t) plane downloaded
+    once to get stats for all of its shapes together.
+    Returns stats in the same order as shape_planes, like get_shape_stats(),
+    or None for all of them if there are no ch_indexes.
+    """
+    if len(ch_indexes) == 0:
+        return [None] * len(shape_planes)
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    shape_pixels = {}
+    plane_rows = defaultdict(list)
+    for row, (shape, z, t) in enumerate(shape_planes):
+        if z is not None and t is not None:
+            if shape.id.val not in shape_pixels:
+                shape_pixels[shape.id.val] = rasterize_shape(shape, size_x,
+                                                             size_y)
+            plane_rows[(z, t)].append(row)
+
+    pixels = image.getPrimaryPixels()
+    all_stats = [None] * len(shape_planes)
+    for (z, t), rows in plane_rows.items():
+        indices = [shape_pixels[shape_planes[row][0].id.val] for row in rows]
+        labels = numpy.repeat(numpy.arange(len(rows)),
+                              [len(i) for i in indices])
+        indices = numpy.concatenate(indices)
+
+        zct_list = [(z, c, t) for c in ch_indexes]
+        channel_stats = []
+        for plane in pixels.getPlanes(zct_list):
+            values = plane.ravel()[indices].astype(numpy.float64)
+            channel_stats.append(label_stats(labels, values, len(rows)))
+
+        for i, row in enumerate(rows):
+            points, mins, maxs, sums, means, std_devs = [
+                [s[i].item() for s in stat] for stat in zip(*channel_stats)]
+            all_stats[row] = ShapeStats(
+                shapeId=shape_planes[row][0].id.val,
+                channelIds=list(ch_indexes), pointsCount=points,
+                min=mins, max=maxs, sum=sums, mean=means, stdDev=std_devs)
+    return all_stats
+
+
+def stack_stats(values):
+    """
+    Reduce values of shape (planes, pixels) over the pixels of each plane.
+
+    Returns arrays of points, min, max, sum, mean and sample standard
+    deviation for each plane, like label_stats().
+    """
+    points = numpy.full(len(values), values.shape[1])
+    if values.shape[1] == 0:
+        zeros = numpy.zeros(len(values))
+        return points, zeros, zeros, zeros, zeros, zeros
+    sums = values.sum(axis=1)
+    means = sums / values.shape[1]
+    squares = ((values - means[:, numpy.newaxis]) ** 2).sum(axis=1)
+    std_devs = numpy.sqrt(squares / max(values.shape[1] - 1, 1))
+    return (points, values.min(axis=1), values.max(axis=1), sums, means,
+            std_devs)
+
+
+def get_stack_shape_stats(store, image, shape, z_indexes, t_indexes,
+                          ch_indexes):
+    """
+    Calculate ShapeStats of shape on each plane of a Z/T stack locally.
+
+    The shape's bounding box is read for every Z and T at once with
+    getHypercube() from the RawPixelsStore store, one call per channel
+    and up to HYPERCUBE_BYTES, and the shape's pixels reduced for all
+    planes together. z_indexes and t_indexes are ranges of planes.
+    Returns stats ordered by Z then T, like the rows of get_export_data().
+    """
+    size_x = image.getSizeX()
+    indices = rasterize_shape(shape, size_x, image.getSizeY())
+    z_indexes = list(z_indexes)
+    t_indexes = list(t_indexes)
+    plane_count = len(z_indexes) * len(t_indexes)
+
+    channel_stats = []
+    if len(indices) == 0:
+        channel_stats = [stack_stats(numpy.zeros((plane_count, 0)))
+                         for c in ch_indexes]
+    else:
+        ys, xs = numpy.divmod(indices, size_x)
+        x, y = xs.min(), ys.min()
+        width, height = xs.max() - x + 1, ys.max() - y + 1
+        # pixels of the shape in the flattened bounding box
+        box_indices = (ys - y) * width + (xs - x)
+        dtype = numpy.dtype(image.getPrimaryPixels().get_numpy_type())
+        dtype = dtype.newbyteorder(">")
+        stack_bytes = len(z_indexes) * height * width * dtype.itemsize
+        t_step = max(1, HYPERCUBE_BYTES // stack_bytes)
+        for c in ch_indexes:
+            values = []
+            for start in range(0, len(t_indexes), t_step):
+                size_t = len(t_indexes[start:start + t_step])
+                data = store.getHypercube(
+                    [int(x), int(y), z_indexes[0], c, t_indexes[start]],
+                    [int(width), int(height), len(z_indexes), 1, size_t],
+                    [1, 1, 1, 1, 1])
+                # hypercubes are in XYZCT order, so index them [t, z, y, x]
+                block = numpy.frombuffer(data, dtype=dtype).reshape(
+                    size_t, len(z_indexes), height * width)
+                values.append(block[:, :, box_indices])
+            values = numpy.concatenate(values).astype(numpy.float64)
+            values = values.transpose(1, 0, 2).reshape(plane_count, -1)
+            channel_stats.append(stack_stats(values))
+
+    all_stats = []
+    for i in range(plane_count):
+        points, mins, maxs, sums, means, std_devs = [
+            [s[i].item() for s in stat] for stat in zip(*channel_stats)]
+        all_stats.append(ShapeStats(
+            shapeId=shape.id.val, channelIds=list(ch_indexes),
+            pointsCount=points, min=mins, max=maxs, sum=sums, mean=means,
+            stdDev=std_devs))
+    return all_stats
+
+
+def benchmark_shape_stats(conn, image, ch_indexes,
+                          batch_size=STATS_BATCH_SIZE):
+    """
+    Time the Server and Client stats backends on all shapes of image.
+
+    Returns (server_seconds, client_seconds, max_diff), where max_diff is
+    the largest difference between the two backends for any statistic.
+    """
+    result = conn.getRoiService().findByImage(image.getId(), None)
+    shapes = [(shape, unwrap(shape.theZ), unwrap(shape.theT))
+              for roi in result.rois for shape in roi.copyShapes()]
+
+    start = time.time()
+    server_stats = get_shape_stats(
+        conn.getRoiService(), [(s.id.val, z, t) for s, z, t in shapes],
+        ch_indexes, batch_size)
+    server_time = time.time() - start
+
+    start = time.time()
+    client_stats = get_client_shape_stats(image, shapes, ch_indexes)
+    client_time = time.time() - start
+
+    max_diff = 0
+    for server, client in zip(server_stats, client_stats):
+        if server is None:
+            continue
+        for name in ("pointsCount", "min", "max", "sum", "mean", "stdDev"):
+            diff = numpy.abs(numpy.subtract(getattr(server, name),
+                                            getattr(client, name)))
+            max_diff = max(max_diff, diff.max())
+    return server_time, client_time, max_diff
+
+
+def get_filter_channel(dataset_name, ch_names):
+    """
+    Get the index of the channel to filter shapes by, default 0.
+
+    For idr0021 use-case, we want to pick filter_channel dynamically...
+    First channel where channel name matches Dataset (or Plate) name.
+    """
+    for c, name in enumerate(ch_names):
+        if name in dataset_name:
+            return c
+    return 0
+
+
+def get_channel_labels(pixels):
+    """Get channel labels as ImageWrapper.getChannelLabels() does."""
+    labels = []
+    for index, channel in enumerate(pixels.copyChannels()):
+        logical_channel = channel.getLogicalChannel()
+        name = unwrap(logical_channel.getName())
+        wave = logical_channel.getEmissionWave()
+        if name is not None and len(name.strip()) > 0:
+            labels.append(name)
+        elif wave is not None and len(str(wave.getValue()).strip()) > 0:
+            value = wave.getValue()
+            # Don't show as double if it's really an int
+            if int(value) == value:
+                value = int(value)
+            labels.append(str(value))
+        else:
+            labels.append(str(index))
+    return labels
+
+
+# Image ID, parent Dataset or Plate and its Project or Screen of the Images
+# to export, in order, and the wrapper for the Project or Screen
+HIERARCHY_QUERIES = {
+    "Project": ("""select i.id, d, p from ProjectDatasetLink pl
+        join pl.parent p join pl.child d join d.imageLinks dl join dl.child i
+        where p.id in (:ids)
+        order by p.name, p.id, d.name, d.id, i.name, i.id""", ProjectWrapper),
+    "Dataset": ("""select i.id, d, p from DatasetImageLink dl
+        join dl.parent d join dl.child i
+        left outer join d.projectLinks pl left outer join pl.parent p
+        where d.id in (:ids) order by d.name, d.id, i.name, i.id, p.id""",
+                ProjectWrapper),
+    "Image": ("""select i.id, d, p from Image i
+        left outer join i.datasetLinks dl left outer join dl.parent d
+        left outer join d.projectLinks pl left outer join pl.parent p
+        where i.id in (:ids) order by i.id, d.id, p.id""", ProjectWrapper),
+    "Screen": ("""select i.id, pl, s from ScreenPlateLink sl
+        join sl.parent s join sl.child pl join pl.wells w
+        join w.wellSamples ws join ws.image i
+        where s.id in (:ids)
+        order by s.name, s.id, pl.name, pl.id, w.row, w.column, ws.id""",
+               ScreenWrapper),
+    "Plate": ("""select i.id, pl, s from WellSample ws
+        join ws.well w join w.plate pl join ws.image i
+        left outer join pl.screenLinks sl left outer join sl.parent s
+        where pl.id in (:ids)
+        order by pl.name, pl.id, w.row, w.column, ws.id, s.id""",
+              ScreenWrapper),
+    "Well": ("""select i.id, pl, s from WellSample ws
+        join ws.well w join w.plate pl join ws.image i
+        left outer join pl.screenLinks sl left outer join sl.parent s
+        where w.id in (:ids) order by w.id, ws.id, s.id""", ScreenWrapper)}
+# Number of (image, parent, container) IDs that list an Image once, e.g.
+# Projects list Images once per Dataset, Datasets once with any Project
+LISTING_KEYS = {"Project": 3, "Screen": 3,
+                "Dataset": 2, "Plate": 2,
+                "Image": 1, "Well": 1}
+
+
+def load_image_objects(conn, image_ids):
+    """Load Images with their Pixels, channels and logical channels."""
+    params = omero.sys.ParametersI()
+    params.addIds(image_ids)
+    query = """select distinct i from Image i
+        join fetch i.pixels pix join fetch pix.pixelsType
+        join fetch pix.channels c join fetch c.logicalChannel
+        where i.id in (:ids)"""
+    return dict((image.id.val, image) for image in conn.getQueryService(
+        ).findAllByQuery(query, params, conn.SERVICE_OPTS))
+
+
+def iter_images(conn, script_params):
+    """
+    Yield (ImageWrapper, metadata) for each Image to export, in order.
+
+    The hierarchy is walked with a paged query, and the Pixels and channels
+    of each page of Images loaded with one more query, so that Images are
+    yielded as soon as their page is loaded.
+    Metadata is a dict of 'parent_name' (Dataset or Plate), 'container'
+    (ProjectWrapper, ScreenWrapper or None), 'channels' labels and the
+    'filter_channel'. An Image is listed once for each Dataset (or
+    Project/Dataset pair etc.) listing it, as when walking the hierarchy
+    with listChildren(). Images without Pixels are skipped.
+    """
+    data_type = script_params['Data_Type']
+    query, container_wrapper = HIERARCHY_QUERIES[data_type]
+    query_service = conn.getQueryService()
+    params = omero.sys.ParametersI()
+    params.addIds(script_params['IDs'])
+    # Rows listing the same Image again are next to each other
+    previous = None
+    offset = 0
+    while True:
+        params.page(offset, IMAGE_PAGE)
+        result = query_service.projection(query, params, conn.SERVICE_OPTS)
+        page = []
+        for row in result:
+            image_id, parent, container = [unwrap(value) for value in row]
+            key = (image_id, parent and parent.id.val,
+                   container and container.id.val)
+            key = key[:LISTING_KEYS[data_type]]
+            if key != previous:
+                page.append((image_id, parent, container))
+            previous = key
+
+        image_objs = {}
+        if len(page) > 0:
+            image_objs = load_image_objects(
+                conn, list(set(row[0] for row in page)))
+        for image_id, parent, container in page:
+            if image_id not in image_objs:
+                continue
+            image = image_objs[image_id]
+            parent_name = unwrap(parent.name) if parent else ""
+            ch_names = get_channel_labels(image.getPrimaryPixels())
+            yield ImageWrapper(conn, image), {
+                "parent_name": parent_name,
+                "container": (container_wrapper(conn, container)
+                              if container else None),
+                "channels": ch_names,
+                "filter_channel": get_filter_channel(parent_name, ch_names)}
+
+        if len(result) < IMAGE_PAGE:
+            break
+        offset += IMAGE_PAGE
+
+
+def string_code(strings, string):
+    """Get the code of string in the strings table, adding it if new."""
+    return strings.setdefault(string, len(strings))
+
+
+def decode_strings(strings, codes):
+    """Get an object array of the strings for an array of codes."""
+    table = numpy.empty(len(strings), dtype=object)
+    table[list(strings.values())] = list(strings.keys())
+    return table[codes]
+
+
+def decode_rows(rows, strings):
+    """
+    Replace the codes in the string columns of rows with their strings.
+
+    strings is the table of the rows of one image, so that decoding doesn't
+    get slower as more images are exported.
+    """
+    for name in STRING_COLUMNS:
+        rows[name] = decode_strings(strings, rows[name])
+    return rows
+
+
+def get_export_data(conn, script_params, image, filter_ch, ch_names,
+                    strings):
+    """
+    Get pixel data for shapes on image and returns dict of column arrays.
+
+    Strings are stored as their code in the strings table.
+    """
     log("Image ID %s..." % image.id)
     roi_service = conn.getRoiService()
     all_planes = script_params["Export_All_Planes"]
@@ -63,23 +626,14 @@ def get_export_data(conn, script_params, image):
             # User input is 1-based
             ch_indexes.append(ch - 1)
 
-    filter_ch = 0
-
-    # For idr0021 use-case, we want to pick filter_channel dynamically...
-    # First channel where channel name matches Dataset name.
-    dataset_name = image.getParent().name
-    for c, name in enumerate(image.getChannelLabels()):
-        if name in dataset_name:
-            filter_ch = c
-
-    ch_names = image.getChannelLabels()
-
-    ch_names = [ch_name.replace(",", ".") for ch_name in ch_names]
-    image_name = image.getName().replace(",", ".")
-
     result = roi_service.findByImage(image.getId(), None)
+    client_stats = script_params.get("Statistics") == "Client"
 
-    export_data = []
+    # list of (roi, shape, label, shape_type, z, t) for each row of stats
+    planes = []
+    # (first row, shape, z_indexes, t_indexes) of shapes on all planes,
+    # with Client statistics
+    stacks = []
     log("Filter_Shapes_By_Channel: %s" % filter_ch)
     for roi in result.rois:
         for shape in roi.copyShapes():
@@ -87,8 +641,7 @@ def get_export_data(conn, script_params, image):
                 log("%s != %s" % (filter_ch, unwrap(shape.theC)))
                 continue
             label = unwrap(shape.getTextValue())
-            # wrap label in double quotes in case it contains comma
-            label = "" if label is None else '"%s"' % label.replace(",", ".")
+            label = "" if label is None else label
             shape_type = shape.__class__.__name__.rstrip('I').lower()
             # If shape has no Z or T, we may go through all planes...
             the_z = unwrap(shape.theZ)
@@ -100,38 +653,78 @@ def get_export_data(conn, script_params, image):
             t_indexes = [the_t]
             if the_t is None and all_planes:
                 t_indexes = range(image.getSizeT())
-            # Get the C shape is on.
-            # This is independent of ch_indexes we're getting intensities for
-            the_c = unwrap(shape.theC)
-
-            # get pixel intensities
+            if client_stats and len(z_indexes) * len(t_indexes) > 1:
+                stacks.append((len(planes), shape, z_indexes, t_indexes))
             for z in z_indexes:
                 for t in t_indexes:
-                    if z is None or t is None:
-                        stats = None
-                    else:
-                        stats = roi_service.getShapeStatsRestricted(
-                            [shape.id.val], z, t, ch_indexes)
-                    for c, ch_index in enumerate(ch_indexes):
-                        export_data.append({
-                            "image_id": image.getId(),
-                            "image_name": '"%s"' % image_name,
-                            "roi_id": roi.id.val,
-                            "shape_id": shape.id.val,
-                            "type": shape_type,
-                            "text": label,
-                            "z": z + 1 if z is not None else "",
-                            "t": t + 1 if t is not None else "",
-                            "c": the_c + 1 if the_c is not None else "",
-                            "points": stats[0].pointsCount[c] if stats else "",
-                            "intensity_for_channel": ch_names[ch_index],
-                            "min": stats[0].min[c] if stats else "",
-                            "max": stats[0].max[c] if stats else "",
-                            "sum": stats[0].sum[c] if stats else "",
-                            "mean": stats[0].mean[c] if stats else "",
-                            "std_dev": stats[0].stdDev[c] if stats else ""
-                        })
-    return export_data
+                    planes.append((roi, shape, label, shape_type, z, t))
+
+    # get pixel intensities for all shapes on the same plane at once,
+    # except for shapes on all planes, below
+    stack_rows = set()
+    for row, shape, z_indexes, t_indexes in stacks:
+        stack_rows.update(range(row, row + len(z_indexes) * len(t_indexes)))
+    shape_planes = [(shape, None, None) if row in stack_rows else (shape, z, t)
+                    for row, (roi, shape, label, shape_type, z, t)
+                    in enumerate(planes)]
+    if client_stats:
+        all_stats = get_client_shape_stats(image, shape_planes, ch_indexes)
+    else:
+        batch_size = script_params.get("Stats_Batch_Size", STATS_BATCH_SIZE)
+        all_stats = get_shape_stats(roi_service, [
+            (shape.id.val, z, t) for shape, z, t in shape_planes],
+            ch_indexes, batch_size)
+
+    # ...and the whole Z/T stack of each shape on all planes at once, as the
+    # Server only gets stats of one plane at a time
+    if len(stacks) > 0 and len(ch_indexes) > 0:
+        store = conn.createRawPixelsStore()
+        try:
+            store.setPixelsId(image.getPixelsId(), True, conn.SERVICE_OPTS)
+            for row, shape, z_indexes, t_indexes in stacks:
+                stats = get_stack_shape_stats(store, image, shape, z_indexes,
+                                              t_indexes, ch_indexes)
+                all_stats[row:row + len(stats)] = stats
+        finally:
+            store.close()
+
+    # one row per plane and channel: stats are (planes, channels) arrays
+    stats_shape = (len(planes), len(ch_indexes))
+    points = numpy.full(stats_shape, EMPTY_INT, dtype=numpy.int64)
+    stats_columns = dict((name, numpy.full(stats_shape, numpy.nan))
+                         for name in STATS_COLUMNS)
+    for row, stats in enumerate(all_stats):
+        if stats is not None:
+            points[row] = stats.pointsCount
+            for name, attr in STATS_COLUMNS.items():
+                stats_columns[name][row] = getattr(stats, attr)
+
+    def one_based(index):
+        return EMPTY_INT if index is None else index + 1
+
+    # Get the C shape is on.
+    # This is independent of ch_indexes we're getting intensities for
+    plane_names = ["roi_id", "shape_id", "type", "text", "z", "t", "c"]
+    plane_columns = numpy.array([
+        (roi.id.val, shape.id.val, string_code(strings, shape_type),
+         string_code(strings, label), one_based(z), one_based(t),
+         one_based(unwrap(shape.theC)))
+        for roi, shape, label, shape_type, z, t in planes],
+        dtype=numpy.int64).reshape(len(planes), len(plane_names))
+    plane_columns = numpy.repeat(plane_columns, len(ch_indexes), axis=0)
+
+    row_count = len(plane_columns)
+    rows = dict(zip(plane_names, plane_columns.T))
+    rows["image_id"] = numpy.full(row_count, image.getId(), dtype=numpy.int64)
+    rows["image_name"] = numpy.full(
+        row_count, string_code(strings, image.getName()), dtype=numpy.int64)
+    rows["points"] = points.ravel()
+    rows["intensity_for_channel"] = numpy.tile(numpy.array(
+        [string_code(strings, ch_names[c]) for c in ch_indexes],
+        dtype=numpy.int64), len(planes))
+    for name, values in stats_columns.items():
+        rows[name] = values.ravel()
+    return rows
 
 
 COLUMN_NAMES = ["image_id",
@@ -151,6 +744,17 @@ COLUMN_NAMES = ["image_id",
                 "mean",
                 "std_dev"]
 
+# Export columns holding codes in the strings table, until decode_rows()
+STRING_COLUMNS = ["image_name", "type", "text", "intensity_for_channel"]
+# Export columns from ShapeStats attributes, NaN where there are no stats
+STATS_COLUMNS = OrderedDict([("min", "min"),
+                             ("max", "max"),
+                             ("sum", "sum"),
+                             ("mean", "mean"),
+                             ("std_dev", "stdDev")])
+# Value of empty integer columns, e.g. Z of a shape on all planes
+EMPTY_INT = -1
+
 SUMMARY_COL_NAMES = ["filter_shapes_by_channel",
                      "shape_count",
                      "min_intensity",
@@ -161,93 +765,230 @@ SUMMARY_COL_NAMES = ["filter_shapes_by_channel",
                      "mean_points"]
 
 
-def link_table(conn, table, project):
-    """Create FileAnnotation for OMERO.table and links to Project."""
+def new_table(conn, table_name):
+    """Create a new OMERO.table in the first repository."""
+    resources = conn.c.sf.sharedResources()
+    repository_id = resources.repositories().descriptions[0].getId().getValue()
+    return resources.newTable(repository_id, table_name)
+
+
+def link_table(conn, table, objects):
+    """Create FileAnnotation for OMERO.table and links to each object."""
     orig_file = table.getOriginalFile()
     file_ann = FileAnnotationWrapper(conn)
     file_ann.setNs(NSBULKANNOTATIONS)
     file_ann._obj.file = OriginalFileI(orig_file.id.val, False)
     file_ann.save()
-    project.linkAnnotation(file_ann)
+    link_annotation(objects, file_ann)
+
+
+def truncate_string(string, size):
+    """Truncate string to at most size bytes of UTF-8."""
+    return string.encode("utf-8")[:size].decode("utf-8", "ignore")
+
+
+def shape_table_columns(rows):
+    """Get decoded export rows as typed OMERO.table columns."""
+    columns = []
+    for name in COLUMN_NAMES:
+        values = rows[name]
+        if name == "image_id":
+            columns.append(ImageColumn("Image", "", values.tolist()))
+        elif name == "roi_id":
+            columns.append(RoiColumn("Roi", "", values.tolist()))
+        elif name in STRING_COLUMNS:
+            size = TABLE_STRING_SIZES[name]
+            columns.append(StringColumn(name, "", size, [
+                truncate_string(string, size) for string in values]))
+        elif values.dtype.kind == "f":
+            columns.append(DoubleColumn(name, "", values.tolist()))
+        else:
+            columns.append(LongColumn(name, "", values.tolist()))
+    return columns
+
+
+def open_shape_table(conn):
+    """Create an OMERO.table for export rows, with no rows yet."""
+    table = new_table(conn, "batch_roi_export_shapes")
+    empty = dict((name, numpy.empty(0, dtype=numpy.int64))
+                 for name in COLUMN_NAMES)
+    for name in STATS_COLUMNS:
+        empty[name] = numpy.empty(0, dtype=numpy.float64)
+    for name in STRING_COLUMNS:
+        empty[name] = numpy.empty(0, dtype=object)
+    try:
+        table.initialize(shape_table_columns(empty))
+    except Exception:
+        table.close()
+        raise
+    return table
+
+
+def add_table_rows(table, pending, batch_size, flush=False):
+    """
+    Add the decoded export rows in the pending list to table, batch_size at
+    a time.
+
+    Rows that don't fill a batch are left in pending, unless flush is True.
+    Empty integer values are -1 and empty statistics are NaN.
+    """
+    if len(pending) == 0:
+        return
+    rows = concat_rows(pending, COLUMN_NAMES)
+    del pending[:]
+    count = len(rows["image_id"])
+    end = count if flush else count - count % batch_size
+    for start in range(0, end, batch_size):
+        table.addData(shape_table_columns(
+            slice_rows(rows, start, min(start + batch_size, end))))
+    if end < count:
+        pending.append(slice_rows(rows, end, count))
+
+
+def concat_rows(blocks, col_names):
+    """Join dicts of column arrays, e.g. for each image, into one."""
+    return dict((name, numpy.concatenate([rows[name] for rows in blocks]))
+                for name in col_names)
+
+
+def slice_rows(rows, start, stop):
+    """Get rows from start to stop of a dict of column arrays."""
+    return dict((name, values[start:stop]) for name, values in rows.items())
+
+
+def csv_column(values):
+    """Format a column as CSV cells, empty for NaN or EMPTY_INT values."""
+    values = numpy.asarray(values)
+    cells = [str(value) for value in values.tolist()]
+    if values.dtype.kind == "f":
+        empty = numpy.isnan(values)
+    elif values.dtype.kind in "iu":
+        empty = values == EMPTY_INT
+    else:
+        return cells
+    for row in numpy.flatnonzero(empty):
+        cells[row] = ""
+    return cells
+
+
+def export_csv_columns(rows):
+    """Get decoded export rows as columns of CSV cells."""
+    return dict((name, csv_column(rows[name])) for name in COLUMN_NAMES)
 
 
-def write_csv(conn, export_data, file_name, col_names):
-    """Write the list of data to a CSV file and create a file annotation."""
+def get_csv_file_name(file_name):
+    """Get the CSV file name to write, DEFAULT_FILE_NAME if empty."""
     if len(file_name) == 0:
         file_name = DEFAULT_FILE_NAME
     if not file_name.endswith(".csv"):
         file_name += ".csv"
+    return file_name
 
-    csv_rows = [",".join(col_names)]
-    for row in export_data:
-        cells = [str(row.get(name)) for name in col_names]
-        csv_rows.append(",".join(cells))
 
-    with open(file_name, 'w') as csv_file:
-        csv_file.write("\n".join(csv_rows))
+def open_csv(file_name, col_names):
+    """
+    Open file_name and write the header row.
 
-    return conn.createFileAnnfromLocalFile(file_name, mimetype="text/csv")
+    Returns (file, csv writer). At most CSV_BUFFER_SIZE bytes are
+    buffered before they are written to disk.
+    """
+    csv_file = open(file_name, 'w', newline='', buffering=CSV_BUFFER_SIZE)
+    writer = csv.writer(csv_file, lineterminator="\n")
+    writer.writerow(col_names)
+    return csv_file, writer
 
 
-def get_summary_data_for_image(conn, image, export_data, script_params):
-    """Summarise ROIs as dict for this Image."""
-    # get all ROI data for this image
-    filter_ch = script_params.get('Filter_Shapes_By_Channel', '')
+def write_export_rows(writer, rows):
+    """Write decoded export rows as CSV, CSV_CHUNK_ROWS rows at a time."""
+    for start in range(0, len(rows["image_id"]), CSV_CHUNK_ROWS):
+        chunk = slice_rows(rows, start, start + CSV_CHUNK_ROWS)
+        columns = export_csv_columns(chunk)
+        writer.writerows(zip(*[columns[name] for name in COLUMN_NAMES]))
 
-    # For idr0021 use-case, we want to pick filter_channel dynamically...
-    # First channel where channel name matches Dataset name.
-    dataset_name = image.getParent().name
-    for c, name in enumerate(image.getChannelLabels()):
-        if name in dataset_name:
-            filter_ch = c + 1
-            break
 
-    data = [d for d in export_data if d['image_id'] == image.id]
-    if len(data) == 0:
-        return None
-    min_intensity = min([d['min'] for d in data])
-    max_intensity = max([d['max'] for d in data])
-    mean_intensity = sum([d['mean'] for d in data]) / len(data)
-    min_points = min([d['points'] for d in data])
-    max_points = max([d['points'] for d in data])
-    mean_points = sum([d['points'] for d in data]) / len(data)
-
-    return {
-        "filter_shapes_by_channel": filter_ch,
-        "shape_count": len(data),
-        "min_intensity": min_intensity,
-        "max_intensity": max_intensity,
-        "mean_intensity": mean_intensity,
-        "min_points": min_points,
-        "max_points": max_points,
-        "mean_points": mean_points,
-    }
-
-
-def group_data_by_image(conn, images, export_data, script_params):
-    """Group ROI data by Images."""
-    # Create a dict of empty lists
-    image_data = defaultdict(list)
-
-    for image in images:
-        data = get_summary_data_for_image(conn, image, export_data,
-                                          script_params)
-        for key in SUMMARY_COL_NAMES:
-            image_data[key].append(data[key] if data is not None else 0)
-
-    return image_data
-
-
-def save_table(conn, images, image_data, script_params, project=None):
+def upload_csv(conn, file_name):
+    """Upload CSV file in UPLOAD_BLOCK_SIZE blocks, as a file annotation."""
+    orig_file = conn.c.upload(file_name, type="text/csv",
+                              block_size=UPLOAD_BLOCK_SIZE)
+    file_ann = FileAnnotationWrapper(conn)
+    file_ann._obj.file = OriginalFileI(orig_file.id.val, False)
+    file_ann.save()
+    return file_ann
+
+
+def write_csv(conn, columns, file_name, col_names):
+    """Write columns of cells to a CSV file and create a file annotation."""
+    file_name = get_csv_file_name(file_name)
+    csv_file, writer = open_csv(file_name, col_names)
+    with csv_file:
+        writer.writerows(zip(*[columns[name] for name in col_names]))
+    return upload_csv(conn, file_name)
+
+
+def summary_column(rows, name):
+    """Get the values of one column as floats, NaN where empty."""
+    values = rows[name].astype(numpy.float64)
+    if rows[name].dtype.kind in "iu":
+        values[rows[name] == EMPTY_INT] = numpy.nan
+    return values
+
+
+def summarise_rows(rows):
+    """
+    Get summary aggregates of export rows, e.g. of one image.
+
+    Means are kept as sums and counts, so that the aggregates of an image
+    listed twice can be merged with merge_summaries().
+    """
+    summary = {"shape_count": len(rows["image_id"])}
+    for key, min_name, max_name, mean_name in (
+            ("intensity", "min", "max", "mean"),
+            ("points", "points", "points", "points")):
+        mins = summary_column(rows, min_name)
+        maxs = summary_column(rows, max_name)
+        means = summary_column(rows, mean_name)
+        summary["min_" + key] = numpy.fmin.reduce(mins, initial=numpy.nan)
+        summary["max_" + key] = numpy.fmax.reduce(maxs, initial=numpy.nan)
+        summary["sum_" + key] = numpy.nansum(means)
+        summary["count_" + key] = numpy.count_nonzero(~numpy.isnan(means))
+    return summary
+
+
+def merge_summaries(summary, other):
+    """Merge the aggregates of other into summary."""
+    for name, value in other.items():
+        if name.startswith("min_"):
+            summary[name] = numpy.fmin(summary[name], value)
+        elif name.startswith("max_"):
+            summary[name] = numpy.fmax(summary[name], value)
+        else:
+            summary[name] += value
+
+
+def get_summary_values(summary, filter_ch):
+    """
+    Get the SUMMARY_COL_NAMES values of an image from its aggregates.
+
+    Images without ROI data have 0 for every value.
+    """
+    shape_count = summary["shape_count"]
+    values = {"filter_shapes_by_channel": filter_ch + 1 if shape_count else 0,
+              "shape_count": shape_count}
+    for key in ("intensity", "points"):
+        values["min_" + key] = summary["min_" + key]
+        values["max_" + key] = summary["max_" + key]
+        values["mean_" + key] = (summary["sum_" + key] /
+                                 max(summary["count_" + key], 1))
+    return dict((name, numpy.nan_to_num(value).item())
+                for name, value in values.items())
+
+
+def save_table(conn, image_ids, image_data, script_params, project=None):
     """Summarise ROIs as Table (1 row per Image) linked to Project."""
-    resources = conn.c.sf.sharedResources()
-    repository_id = resources.repositories().descriptions[0].getId().getValue()
-    table_name = "batch_roi_export"
-    table = resources.newTable(repository_id, table_name)
+    table = new_table(conn, "batch_roi_export")
 
     try:
         # Create table
-        image_ids = [i.id for i in images]
         img_column = ImageColumn('Image', '', image_ids)
         cols = [DoubleColumn(k, '', image_data[k]) for k in SUMMARY_COL_NAMES]
         data = [img_column] + cols
@@ -257,26 +998,61 @@ def save_table(conn, images, image_data, script_params, project=None):
         if project is None:
             log("No Project found to link table")
         else:
-            link_table(conn, table, project)
+            link_table(conn, table, [project])
 
     finally:
         # after linking, we can close
         table.close()
 
 
-def save_map_annotations(conn, images, image_data, script_params):
-    """Summarise ROIs as Key-Value pairs for each Image."""
-    for i, image in enumerate(images):
-        key_value_data = []
-        for col_name in SUMMARY_COL_NAMES:
-            col_data = image_data.get(col_name)
-            key_value_data.append([col_name, str(col_data[i])])
-        map_ann = MapAnnotationWrapper(conn)
+def find_map_annotations(conn, image_ids):
+    """Get the IDs of BATCH_ROI_EXPORT_NS map annotations on the Images."""
+    params = omero.sys.ParametersI()
+    params.addIds(image_ids)
+    params.addString("ns", BATCH_ROI_EXPORT_NS)
+    query = """select distinct link.child.id from ImageAnnotationLink link
+        where link.parent.id in (:ids) and link.child.ns = :ns"""
+    result = conn.getQueryService().projection(query, params,
+                                               conn.SERVICE_OPTS)
+    return [unwrap(row[0]) for row in result]
+
+
+def save_map_annotations(conn, image_ids, image_data, script_params):
+    """
+    Summarise ROIs as Key-Value pairs for each Image.
+
+    Map annotations and their links are saved together for MAP_ANN_BATCH
+    images at a time. With Replace_Key-Value, the BATCH_ROI_EXPORT_NS
+    annotations already on those images are deleted first.
+    """
+    links = []
+    annotated_ids = []
+    seen = set()
+    for i, image_id in enumerate(image_ids):
+        # an Image in 2 Datasets only needs its Key-Value pairs once
+        if image_id in seen:
+            continue
+        seen.add(image_id)
+        annotated_ids.append(image_id)
+        map_ann = MapAnnotationI()
         # Use custom namespace to allow finding/deleting map_anns we create
-        map_ann.setNs(BATCH_ROI_EXPORT_NS)
-        map_ann.setValue(key_value_data)
-        map_ann.save()
-        image.linkAnnotation(map_ann)
+        map_ann.ns = rstring(BATCH_ROI_EXPORT_NS)
+        map_ann.setMapValue([NamedValue(col_name, str(image_data[col_name][i]))
+                             for col_name in SUMMARY_COL_NAMES])
+        link = ImageAnnotationLinkI()
+        link.parent = ImageI(image_id, False)
+        link.child = map_ann
+        links.append(link)
+
+    update_service = conn.getUpdateService()
+    for start in range(0, len(links), MAP_ANN_BATCH):
+        if script_params.get("Replace_Key-Value"):
+            to_delete = find_map_annotations(
+                conn, annotated_ids[start:start + MAP_ANN_BATCH])
+            if len(to_delete) > 0:
+                conn.deleteObjects('Annotation', to_delete, wait=True)
+        update_service.saveAndReturnArray(links[start:start + MAP_ANN_BATCH],
+                                          conn.SERVICE_OPTS)
 
 
 def link_annotation(objects, file_ann):
@@ -286,86 +1062,401 @@ def link_annotation(objects, file_ann):
             o.linkAnnotation(file_ann)
 
 
+def export_image(conn, script_params, image, filter_ch, ch_names):
+    """
+    Get the export rows of one image, using conn.
+
+    Returns the rows and their own strings table, so that images can be
+    exported in parallel and their rows decoded in order afterwards.
+    """
+    image = image.__class__(conn, image._obj)
+    strings = {}
+    rows = get_export_data(conn, script_params, image, filter_ch, ch_names,
+                           strings)
+    return rows, strings
+
+
+def join_session(conn):
+    """Return a new BlitzGateway connection to the same session as conn."""
+    client = omero.client(pmap=conn.c.getPropertyMap())
+    client.joinSession(conn.c.getSessionId())
+    worker_conn = BlitzGateway(client_obj=client)
+    worker_conn.SERVICE_OPTS.setOmeroGroup(conn.SERVICE_OPTS.getOmeroGroup())
+    return worker_conn
+
+
+def run_tasks(conn, func, tasks, workers=1):
+    """
+    Call func(conn, *task) for each task and yield results in task order.
+
+    tasks may be any iterable, e.g. a generator, and is only read as far as
+    needed to keep the workers busy.
+    If workers > 1, tasks run in a pool of up to that many threads (capped
+    at MAX_WORKERS), each with its own connection joined to the session of
+    conn. At most 2 * workers tasks are started ahead of the result being
+    yielded. Joined connections are closed without killing the session.
+    """
+    workers = min(workers, MAX_WORKERS)
+    if workers <= 1:
+        for task in tasks:
+            yield func(conn, *task)
+        return
+
+    local = threading.local()
+    worker_conns = []
+    lock = threading.Lock()
+
+    def call(task):
+        worker_conn = getattr(local, 'conn', None)
+        if worker_conn is None:
+            worker_conn = join_session(conn)
+            local.conn = worker_conn
+            with lock:
+                worker_conns.append(worker_conn)
+        return func(worker_conn, *task)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = deque()
+            for task in tasks:
+                futures.append(pool.submit(call, task))
+                if len(futures) >= 2 * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+    finally:
+        for worker_conn in worker_conns:
+            worker_conn.close(hard=False)
+
+
+def get_shape_versions(conn, image_ids):
+    """
+    Get a digest of the IDs and versions of each Image's shapes.
+
+    The digest changes when shapes are added, edited or deleted.
+    """
+    hashes = dict((image_id, hashlib.sha1()) for image_id in image_ids)
+    query = """select s.roi.image.id, s.id, s.version from Shape s
+        where s.roi.image.id in (:ids) order by s.id"""
+    query_service = conn.getQueryService()
+    for start in range(0, len(image_ids), ID_BATCH):
+        params = omero.sys.ParametersI()
+        params.addIds(image_ids[start:start + ID_BATCH])
+        offset = 0
+        while True:
+            params.page(offset, SHAPE_PAGE)
+            result = query_service.projection(query, params,
+                                              conn.SERVICE_OPTS)
+            for image_id, shape_id, version in unwrap(result):
+                hashes[image_id].update(
+                    ("%s:%s," % (shape_id, version)).encode("utf-8"))
+            if len(result) < SHAPE_PAGE:
+                break
+            offset += SHAPE_PAGE
+    return dict((image_id, h.hexdigest()) for image_id, h in hashes.items())
+
+
+def get_checkpoint_path(conn, script_params):
+    """Get the checkpoint file of this user's export with these params."""
+    key = [conn.getUserId(), conn.SERVICE_OPTS.getOmeroGroup()]
+    key.extend([script_params.get(name) for name in CHECKPOINT_PARAMS])
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+    return os.path.join(CHECKPOINT_DIR, "%s.ckpt" % digest)
+
+
+def lock_checkpoint(path):
+    """
+    Open the checkpoint file at path, creating it if needed, and lock it.
+
+    Returns None if another export has the file locked.
+    """
+    while True:
+        checkpoint = open(path, 'a+b')
+        try:
+            fcntl.flock(checkpoint, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            checkpoint.close()
+            return None
+        # another export may have removed the file before it was locked
+        try:
+            if os.path.samestat(os.fstat(checkpoint.fileno()),
+                                os.stat(path)):
+                return checkpoint
+        except OSError:
+            pass
+        checkpoint.close()
+
+
+def expire_checkpoints():
+    """Delete checkpoints not written to for CHECKPOINT_MAX_AGE seconds."""
+    for name in os.listdir(CHECKPOINT_DIR):
+        path = os.path.join(CHECKPOINT_DIR, name)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            continue
+        if name.endswith(".ckpt") and age > CHECKPOINT_MAX_AGE:
+            remove_checkpoint(path)
+
+
+def open_checkpoint(path):
+    """
+    Open a checkpoint file to append records to, creating it if needed.
+
+    Each record is a JSON header line with the key, strings table and data
+    size of an image, followed by its column arrays in .npy format.
+    Returns a dict of key: offset of each complete record, and the file,
+    locked until it is closed. An incomplete record at the end, e.g. from
+    a lost session, is removed. If another export with the same parameters
+    is running, returns an empty dict and None.
+    """
+    if not os.path.exists(CHECKPOINT_DIR):
+        os.makedirs(CHECKPOINT_DIR, 0o700)
+    expire_checkpoints()
+    checkpoint = lock_checkpoint(path)
+    if checkpoint is None:
+        log("Checkpoint %s is in use by another export" % path)
+        return {}, None
+    checkpoint.seek(0)
+    offsets = {}
+    end = 0
+    while True:
+        offset = checkpoint.tell()
+        line = checkpoint.readline()
+        try:
+            header = json.loads(line.decode("utf-8"))
+        except ValueError:
+            break
+        checkpoint.seek(header["size"], os.SEEK_CUR)
+        if checkpoint.tell() > os.fstat(checkpoint.fileno()).st_size:
+            break
+        offsets[tuple(header["key"])] = offset
+        end = checkpoint.tell()
+    checkpoint.truncate(end)
+    return offsets, checkpoint
+
+
+def read_checkpoint(checkpoint, offset):
+    """Read the export rows and strings table of the record at offset."""
+    checkpoint.seek(offset)
+    header = json.loads(checkpoint.readline().decode("utf-8"))
+    rows = dict((name, numpy.load(checkpoint, allow_pickle=False))
+                for name in COLUMN_NAMES)
+    strings = dict((string, code)
+                   for code, string in enumerate(header["strings"]))
+    return rows, strings
+
+
+def write_checkpoint(checkpoint, key, rows, strings):
+    """Append the export rows and strings table of an image."""
+    data = io.BytesIO()
+    for name in COLUMN_NAMES:
+        numpy.save(data, rows[name], allow_pickle=False)
+    header = {"key": list(key),
+              "strings": sorted(strings, key=strings.get),
+              "size": len(data.getvalue())}
+    checkpoint.seek(0, os.SEEK_END)
+    checkpoint.write(json.dumps(header).encode("utf-8") + b"\n")
+    checkpoint.write(data.getvalue())
+    checkpoint.flush()
+
+
+def iter_chunks(items, size):
+    """Yield lists of up to size items from the iterable items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def export_listed_image(conn, script_params, image, meta, key, offsets):
+    """
+    Export an image of export_images(), unless its key is in offsets.
+
+    Returns the image, metadata and key with the export rows and strings
+    table, or None for the rows of images to read from the checkpoint.
+    """
+    result = None
+    if key not in offsets:
+        result = export_image(conn, script_params, image,
+                              meta["filter_channel"], meta["channels"])
+    return image, meta, key, result
+
+
+def export_images(conn, script_params, images):
+    """
+    Yield (image, metadata, rows, strings) for each (image, metadata).
+
+    images may be a generator, e.g. iter_images(), and is only read
+    ID_BATCH images at a time, ahead of the images being exported.
+    With Checkpoint, each image is appended to a local checkpoint file as
+    it is exported. Images in the checkpoint of an earlier run with the
+    same parameters are read from it instead, unless their shapes or
+    filter channel have changed.
+    """
+    workers = script_params.get("Workers", 1)
+    checkpoint = None
+    offsets = {}
+    if script_params.get("Checkpoint"):
+        offsets, checkpoint = open_checkpoint(
+            get_checkpoint_path(conn, script_params))
+
+    def get_tasks():
+        for chunk in iter_chunks(images, ID_BATCH):
+            versions = {}
+            if checkpoint is not None:
+                versions = get_shape_versions(
+                    conn, list(set(image.id for image, meta in chunk)))
+            for image, meta in chunk:
+                key = (image.id, meta["filter_channel"],
+                       versions.get(image.id))
+                yield script_params, image, meta, key, offsets
+
+    reused = 0
+    results = run_tasks(conn, export_listed_image, get_tasks(), workers)
+    try:
+        for image, meta, key, result in results:
+            if result is None:
+                reused += 1
+                result = read_checkpoint(checkpoint, offsets[key])
+            elif checkpoint is not None:
+                write_checkpoint(checkpoint, key, *result)
+            yield (image, meta) + tuple(result)
+    finally:
+        results.close()
+        if checkpoint is not None:
+            checkpoint.close()
+            log("Reused %s images from checkpoint" % reused)
+
+
+def remove_checkpoint(path):
+    """Delete a checkpoint, unless another export has it locked."""
+    if not os.path.exists(path):
+        return
+    checkpoint = lock_checkpoint(path)
+    if checkpoint is not None:
+        try:
+            os.remove(path)
+        finally:
+            checkpoint.close()
+
+
+def get_parents(conn, script_params):
+    """Get the Projects, Datasets, Screens etc. to link exported files to."""
+    return list(conn.getObjects(script_params['Data_Type'],
+                                script_params['IDs']))
+
+
 def batch_roi_export(conn, script_params):
     """Main entry point. Get images, process them and return result."""
-    images = []
-    datasets = None
-    if script_params['Data_Type'] == "Project":
-        datasets = []
-        for project in conn.getObjects("Project", script_params['IDs']):
-            datasets.extend(list(project.listChildren()))
-    elif script_params['Data_Type'] == "Dataset":
-        datasets = conn.getObjects("Dataset", script_params['IDs'])
-
-    if datasets is not None:
-        for dataset in datasets:
-            images.extend(list(dataset.listChildren()))
-    else:
-        images = list(conn.getObjects("Image", script_params['IDs']))
-
-    log("Processing %s images..." % len(images))
-    if len(images) == 0:
+    images = iter_images(conn, script_params)
+    first = next(images, None)
+    if first is None:
+        log("No images found")
         return None
+    images = itertools.chain([first], images)
 
-    # build a list of dicts.
-    export_data = []
-    for image in images:
-        export_data.extend(get_export_data(conn, script_params, image))
-
-    # Write to csv
-    file_ann = None
+    # Write each image's rows to csv as soon as they are exported
+    csv_file = None
     if script_params.get("Export_CSV"):
-        file_name = script_params.get("File_Name", "")
-        file_ann = write_csv(conn, export_data, file_name, COLUMN_NAMES)
-        if script_params['Data_Type'] == "Project":
-            projects = conn.getObjects("Project", script_params['IDs'])
-            link_annotation(projects, file_ann)
-        elif script_params['Data_Type'] == "Dataset":
-            datasets = conn.getObjects("Dataset", script_params['IDs'])
-            link_annotation(datasets, file_ann)
-        else:
-            link_annotation(images, file_ann)
+        file_name = get_csv_file_name(script_params.get("File_Name", ""))
+        csv_file, writer = open_csv(file_name, COLUMN_NAMES)
+
+    # ...and add them to the shape table in batches
+    shape_table = None
+    pending = []
+    if script_params.get("Create_Shape_Table"):
+        shape_table = open_shape_table(conn)
+    table_batch = script_params.get("Table_Batch_Size", TABLE_BATCH_ROWS)
+
+    # Rows are decoded with each image's own strings table and not kept.
+    # Only the name, parent name and summary aggregates of each image are
+    # kept (about 1.3 kB per image) for the summary outputs, which need all
+    # images, with the first Project or Screen to link them to.
+    listed = []
+    summaries = {}
+    project = None
+    shape_count = 0
+    try:
+        for image, meta, rows, image_strings in export_images(
+                conn, script_params, images):
+            rows = decode_rows(rows, image_strings)
+            if csv_file is not None:
+                write_export_rows(writer, rows)
+                csv_file.flush()
+            if shape_table is not None:
+                pending.append(rows)
+                add_table_rows(shape_table, pending, table_batch)
+            listed.append((image.id, image.getName(), meta["parent_name"]))
+            summary = summarise_rows(rows)
+            if image.id in summaries:
+                merge_summaries(summaries[image.id][0], summary)
+            else:
+                summaries[image.id] = (summary, meta["filter_channel"])
+            if project is None:
+                project = meta["container"]
+            shape_count += summary["shape_count"]
+        if shape_table is not None:
+            add_table_rows(shape_table, pending, table_batch, flush=True)
+            link_table(conn, shape_table, get_parents(conn, script_params))
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+        if shape_table is not None:
+            shape_table.close()
+
+    log("Processed %s images" % len(listed))
 
-    # Group ROI data by Image (ordered same as images)
-    image_data = group_data_by_image(conn, images, export_data, script_params)
+    # Upload csv
+    file_ann = None
+    if csv_file is not None:
+        file_ann = upload_csv(conn, file_name)
+        link_annotation(get_parents(conn, script_params), file_ann)
+
+    # Summary of each Image (ordered same as listed)
+    image_ids = [image_id for image_id, name, parent_name in listed]
+    image_data = dict((name, []) for name in SUMMARY_COL_NAMES)
+    for image_id in image_ids:
+        values = get_summary_values(*summaries[image_id])
+        for name in SUMMARY_COL_NAMES:
+            image_data[name].append(values[name])
 
     # Create Map_Annotations on each image
     if script_params.get("Save_As_Key-Value"):
-        save_map_annotations(conn, images, image_data, script_params)
-
-    # Link Table and CSV to first Project we find
-    project = None
-    for image in images:
-        project = image.getProject()
-        if project is not None:
-            break
+        save_map_annotations(conn, image_ids, image_data, script_params)
 
     # Create single OMERO.table
     if script_params.get("Create_Table"):
-        save_table(conn, images, image_data, script_params, project)
+        save_table(conn, image_ids, image_data, script_params, project)
 
         image_csv_cols = ["image_id", "name", "dataset"] + SUMMARY_COL_NAMES
         # Save image_data as CSV on Project
-        csv_data = []
-        # convert image_data from dict of lists to a list of dicts!
-        for i, image in enumerate(images):
-            row = {"image_id": str(image.getId()),
-                   "name": image.getName(),
-                   "dataset": image.getParent().getName()}
-            for k in SUMMARY_COL_NAMES:
-                row[k] = image_data.get(k)[i]
-            csv_data.append(row)
-        csv_ann = write_csv(conn, csv_data, "batch_roi_export.csv",
+        csv_columns = {
+            "image_id": [str(image_id) for image_id in image_ids],
+            "name": [name for image_id, name, parent_name in listed],
+            "dataset": [parent_name for image_id, name, parent_name in listed]}
+        for k in SUMMARY_COL_NAMES:
+            csv_columns[k] = csv_column(image_data[k])
+        csv_ann = write_csv(conn, csv_columns, "batch_roi_export.csv",
                             image_csv_cols)
-        project.linkAnnotation(csv_ann)
+        if project is not None:
+            project.linkAnnotation(csv_ann)
+
+    if script_params.get("Checkpoint"):
+        remove_checkpoint(get_checkpoint_path(conn, script_params))
 
-    message = "Exported %s shapes" % len(export_data)
+    message = "Exported %s shapes" % shape_count
     return file_ann, message
 
 
 def run_script():
     """The main entry point of the script, as called by the client."""
-    data_types = [rstring('Project'), rstring('Dataset'), rstring('Image')]
+    data_types = [rstring('Project'), rstring('Dataset'), rstring('Image'),
+                  rstring('Screen'), rstring('Plate'), rstring('Well')]
 
     client = scripts.client(
         'Batch_ROI_Export.py',
@@ -378,7 +1469,19 @@ def run_script():
 
         scripts.List(
             "IDs", optional=False, grouping="2",
-            description="List of Dataset IDs or Image IDs.").ofType(rlong(0)),
+            description=("List of Project, Dataset, Image, Screen, Plate"
+                         " or Well IDs.")).ofType(rlong(0)),
+
+        scripts.String(
+            "Statistics", grouping="3", default="Server",
+            values=[rstring("Server"), rstring("Client")],
+            description=("Calculate intensities on the Server, or in this"
+                         " script from whole planes of raw pixels")),
+
+        scripts.Int(
+            "Stats_Batch_Size", grouping="3.1", default=STATS_BATCH_SIZE,
+            min=1, description=("Maximum number of shapes on the same plane"
+                                " to get intensities for in one call")),
 
         scripts.List(
             "Intensity_For_Channels", grouping="4", default=[1, 2, 3, 4],
@@ -403,11 +1506,35 @@ def run_script():
             "Save_As_Key-Value",  grouping="7", default=True,
             description="Summarise ROIs as Key-Value pairs on each Image."),
 
+        scripts.Bool(
+            "Replace_Key-Value", grouping="7.1", default=False,
+            description=("Delete Key-Value pairs from previous exports"
+                         " on each Image")),
+
         scripts.Bool(
             "Create_Table",  grouping="8", default=True,
             description=("Summarise ROIs as Table (1 row per image)"
                          " attached to parent Project")),
 
+        scripts.Bool(
+            "Create_Shape_Table", grouping="9", default=False,
+            description=("Export the data for every shape as a Table"
+                         " attached like the CSV file")),
+
+        scripts.Int(
+            "Table_Batch_Size", grouping="9.1", default=TABLE_BATCH_ROWS,
+            min=1, description="Number of rows to add to the Table at once"),
+
+        scripts.Int(
+            "Workers", grouping="10", default=1, min=1, max=MAX_WORKERS,
+            description="Number of sessions exporting images in parallel"),
+
+        scripts.Bool(
+            "Checkpoint", grouping="11", default=False,
+            description=("Save each exported image locally, to resume an"
+                         " export with the same parameters if it fails."
+                         " Unused checkpoints are deleted after 7 days")),
+
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
         contact="ome-users@lists.openmicroscopy.org.uk",
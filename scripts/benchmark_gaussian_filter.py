@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   Redistribution and use in source and binary forms, with or without modification, 
+#   are permitted provided that the following conditions are met:
+# 
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#   Redistributions in binary form must reproduce the above copyright notice, 
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#   ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED 
+#   WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+#   IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+#   INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY OR CONSEQUENTIAL DAMAGES (INCLUDING,
+#   BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+#   OR PROFITS; OR BUSINESS INTERRUPTION)
+#   HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#   OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS 
+#   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ------------------------------------------------------------------------------
+
+
+"""
+Compare gaussian_filter() with the FFT filter of scipy_gaussian_filter.
+
+Needs scipy_gaussian_filter.py next to this script, but not omero: only
+the filter functions and their imports are loaded from it, as the OMERO
+script itself needs omero and Python 2. Planes are random.
+"""
+
+import ast
+import os
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "scipy_gaussian_filter.py")
+# Imports, constants and functions used by benchmark_filter()
+FILTER_NAMES = ["time", "numpy", "spi", "scipy", "FFT_MIN_RADIUS",
+                "get_radius", "gaussian_kernel", "fft_gaussian_filter",
+                "benchmark_filter"]
+
+
+def load_filters(path=SCRIPT):
+    """Return the FILTER_NAMES of the script at path, without running it."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    nodes = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            names = [node.name]
+        elif isinstance(node, ast.Assign):
+            names = [t.id for t in node.targets if isinstance(t, ast.Name)]
+        elif isinstance(node, ast.Import):
+            names = [(a.asname or a.name).split(".")[0] for a in node.names]
+        else:
+            continue
+        if any(name in FILTER_NAMES for name in names):
+            nodes.append(node)
+    namespace = {}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), path, "exec"),
+         namespace)
+    return namespace
+
+
+# main
+if __name__ == "__main__":
+    filters = load_filters()
+    sigmas = input("Sigmas [1,2,5,10,20,50]: ") or '1,2,5,10,20,50'
+    sizes = input("Plane sizes [512,1024,2048]: ") or '512,1024,2048'
+    window = int(input("Kernel window size [0 for 4 sigma]: ") or 0)
+
+    benchmark_filter = filters["benchmark_filter"]
+    rows = benchmark_filter([float(s) for s in sigmas.split(",")],
+                            [int(s) for s in sizes.split(",")], window)
+    print("FFT filter used from radius %s" % filters["FFT_MIN_RADIUS"])
+    print("size\tsigma\tradius\tdirect (s)\tFFT (s)\tlargest difference")
+    for size, sigma, radius, direct_time, fft_time, max_diff in rows:
+        print("%s\t%s\t%s\t%.4f\t%.4f\t%s" % (
+            size, sigma, radius, direct_time, fft_time, max_diff))
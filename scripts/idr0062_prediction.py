@@ -27,7 +27,6 @@
 #
 
 import numpy
-import re
 
 # omero
 from omero.gateway import BlitzGateway
@@ -40,6 +39,8 @@ from cellpose import io, models, utils
 from geojson import Feature, FeatureCollection, Polygon
 import geojson
 
+from shape_points import outline_string_to_array
+
 # Connect to the server
 def connect(hostname, username, password):
     """
@@ -133,13 +134,8 @@ def predict(image_id, data, model, size_z):
         io.outlines_to_text(name, outlines)
         with open(name + "_cp_outlines.txt", "r") as text_file:
             for line in text_file:
-                points = re.sub(r',([^,]*),', r',\1, ', line)
-                splited = re.split('\s+', points)
-                coordinates = []
-                for value in splited:
-                    point = re.split(',', value)
-                    if len(point) > 1:
-                        coordinates.append((float(point[0]), float(point[1])))
+                xy = outline_string_to_array(line)
+                coordinates = [tuple(point) for point in xy.tolist()]
                 # append the first coordinate to close the polygon
                 coordinates.append(coordinates[0])
                 shape = Polygon(coordinates)
@@ -26,7 +26,6 @@
 # Version: 1.0
 #
 
-import re
 import numpy
 
 # omero
@@ -38,6 +37,8 @@ from getpass import getpass
 # cellpose
 from cellpose import io, models, utils
 
+from shape_points import array_to_points_string, outline_string_to_array
+
 
 
 # Connect to the server
@@ -135,7 +136,8 @@ def predict(image, data, model, size_z):
             for line in text_file:
                 roi = omero.model.RoiI()
                 roi.setImage(image._obj)
-                points = re.sub(r',([^,]*),', r',\1, ', line)
+                points = array_to_points_string(
+                    outline_string_to_array(line))
                 polygon = omero.model.PolygonI()
                 polygon.theZ = omero.rtypes.rint(z)
                 polygon.strokeWidth = omero.model.LengthI(2, omero.model.enums.UnitsLength.PIXEL)
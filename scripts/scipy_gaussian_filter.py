@@ -40,8 +40,19 @@ from omero.rtypes import *  # noqa
 
 import json
 from cStringIO import StringIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy
 import scipy.ndimage as spi
+import scipy.signal
+
+# Maximum number of threads filtering planes
+MAX_WORKERS = 8
+# Maximum number of planes downloaded ahead of being filtered
+PREFETCH_PLANES = 4
+# Smallest kernel radius filtered with FFTs instead of gaussian_filter()
+FFT_MIN_RADIUS = 32
 
 
 def run(conn, params):
@@ -57,6 +68,7 @@ def run(conn, params):
     # Get parameters. These are 'required' so we know they will be populated
     window_size = params.get("Kernel_Window_Size")
     sigma = params.get("Sigma")
+    workers = min(params.get("Workers", 1), MAX_WORKERS)
 
     images = []
 
@@ -90,7 +102,7 @@ def run(conn, params):
                 for t in range(sizeT):
                     zctList.append((z, c, t))
 
-        plane = planeGen(image, zctList, window_size, sigma)
+        plane = planeGen(image, zctList, window_size, sigma, workers)
         name = image.getName() + "_gaussian"
         i = conn.createImageFromNumpySeq(plane, name, sizeZ, sizeC,
                                          sizeT, description="Gaussian Filter",
@@ -103,12 +115,130 @@ def run(conn, params):
     return image_ids, new_dataset
 
 
-def planeGen(image, zctList, window, sigma):
-    """Generator will yield planes."""
+def get_radius(window, sigma):
+    """
+    Get the radius of the gaussian kernel for a Kernel_Window_Size.
+
+    The window is the width of the kernel, rounded down to an odd width:
+    a window of 1 or 2 leaves the plane unchanged. Without a window, the
+    kernel is truncated at 4 sigma, as gaussian_filter() does by default.
+    """
+    if not window:
+        return int(4.0 * sigma + 0.5)
+    return max(0, (int(window) - 1) // 2)
+
+
+def gaussian_kernel(sigma, radius):
+    """Return the normalized 1D gaussian kernel, 2 * radius + 1 long."""
+    x = numpy.arange(-radius, radius + 1)
+    kernel = numpy.exp(-0.5 * (x / float(sigma)) ** 2)
+    return kernel / kernel.sum()
+
+
+def fft_gaussian_filter(plane, sigma, radius):
+    """
+    Apply the gaussian filter to a 2D plane with FFT convolutions.
+
+    Each axis is convolved in turn, so the time does not depend on the
+    radius. As with gaussian_filter(), edges are reflected and integer
+    planes truncated to their type after each axis.
+    """
+    kernel = gaussian_kernel(sigma, radius)
+    result = plane
+    for axis in range(2):
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (radius, radius)
+        data = numpy.pad(result.astype(numpy.float64), pad, 'symmetric')
+        data = scipy.signal.fftconvolve(
+            data, kernel.reshape((-1, 1) if axis == 0 else (1, -1)),
+            mode='valid')
+        if numpy.issubdtype(plane.dtype, numpy.integer):
+            info = numpy.iinfo(plane.dtype)
+            data = numpy.clip(numpy.trunc(data), info.min, info.max)
+        result = data.astype(plane.dtype)
+    return result
+
+
+def filter_plane(plane, window, sigma):
+    """
+    Apply the gaussian filter to a 2D plane, truncated to the window.
+
+    Kernels with a radius of FFT_MIN_RADIUS or more use
+    fft_gaussian_filter().
+    """
+    if sigma <= 0:
+        return spi.filters.gaussian_filter(plane, sigma=sigma)
+    radius = get_radius(window, sigma)
+    if radius >= FFT_MIN_RADIUS:
+        return fft_gaussian_filter(plane, sigma, radius)
+    return spi.filters.gaussian_filter(plane, sigma=sigma,
+                                       truncate=radius / float(sigma))
+
+
+def benchmark_filter(sigmas, sizes, window=None):
+    """
+    Time gaussian_filter() and fft_gaussian_filter() on random planes.
+
+    Returns a list of (size, sigma, radius, direct_seconds, fft_seconds,
+    max_diff) for each square plane size and sigma, e.g. to choose
+    FFT_MIN_RADIUS.
+    """
+    rows = []
+    for size in sizes:
+        plane = numpy.random.random((size, size)).astype(numpy.float32)
+        for sigma in sigmas:
+            radius = get_radius(window, sigma)
+            start = time.time()
+            direct = spi.filters.gaussian_filter(
+                plane, sigma=sigma, truncate=radius / float(sigma))
+            direct_time = time.time() - start
+            start = time.time()
+            fft = fft_gaussian_filter(plane, sigma, radius)
+            fft_time = time.time() - start
+            rows.append((size, sigma, radius, direct_time, fft_time,
+                         float(numpy.abs(direct - fft).max())))
+    return rows
+
+
+def planeGen(image, zctList, window, sigma, workers=1):
+    """
+    Generator will yield planes.
+
+    With workers > 1, the planes are filtered in a pool of threads while
+    earlier planes are yielded, e.g. uploaded. One thread downloads up to
+    PREFETCH_PLANES planes ahead, and planes are yielded in zctList order.
+    """
     planes = image.getPrimaryPixels().getPlanes(zctList)
-    for p in planes:
-        data = spi.filters.gaussian_filter(p, sigma=sigma)
-        yield data
+    if workers <= 1:
+        for p in planes:
+            yield filter_plane(p, window, sigma)
+        return
+
+    # getPlanes() is only iterated by the single fetcher thread
+    fetcher = ThreadPoolExecutor(max_workers=1)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    downloads = deque()
+    filtered = deque()
+    try:
+        requested = 0
+        while requested < min(PREFETCH_PLANES, len(zctList)):
+            downloads.append(fetcher.submit(next, planes))
+            requested += 1
+        while downloads or filtered:
+            while downloads and len(filtered) < workers:
+                plane = downloads.popleft().result()
+                if requested < len(zctList):
+                    downloads.append(fetcher.submit(next, planes))
+                    requested += 1
+                filtered.append(pool.submit(filter_plane, plane, window,
+                                            sigma))
+            yield filtered.popleft().result()
+    finally:
+        for future in list(downloads) + list(filtered):
+            future.cancel()
+        fetcher.shutdown()
+        pool.shutdown()
+        planes.close()
 
 
 def add_map_annotation(conn, image, params):
@@ -377,7 +507,9 @@ if __name__ == "__main__":
 
         scripts.Int(
             "Kernel_Window_Size", optional=False, grouping="3", default=20,
-            description="Window size for the gaussian filter"),
+            description=("Width of the gaussian kernel in pixels, rounded"
+                         " down to an odd width, or 0 to truncate it at"
+                         " 4 sigma")),
 
         scripts.Int(
             "Sigma", optional=False, grouping="4", default=2,
@@ -387,6 +519,10 @@ if __name__ == "__main__":
             "Create_Omero_Figure", default=True, grouping="5",
             description="Create An OMERO.Figure from the resultant images"),
 
+        scripts.Int(
+            "Workers", grouping="6", default=4, min=1, max=MAX_WORKERS,
+            description="Number of threads filtering planes in parallel"),
+
         authors=["Balaji Ramalingam", "OME Team"],
         institutions=["University of Dundee"],
         contact="ome-users@lists.openmicroscopy.org.uk",
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------------------------------------------------------------------
+#   Copyright (C) 2026 University of Dundee. All rights reserved.
+
+#   Redistribution and use in source and binary forms, with or without modification, 
+#   are permitted provided that the following conditions are met:
+# 
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#   Redistributions in binary form must reproduce the above copyright notice, 
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#   ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED 
+#   WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+#   IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+#   INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY OR CONSEQUENTIAL DAMAGES (INCLUDING,
+#   BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+#   OR PROFITS; OR BUSINESS INTERRUPTION)
+#   HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#   OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS 
+#   SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ------------------------------------------------------------------------------
+
+"""
+Convert between OMERO shape 'points' strings and NumPy arrays.
+
+Used by the idr0062_prediction client scripts. Needs to be on the PYTHONPATH
+of the scripts that import it, e.g. next to them.
+The Kymograph, Kymograph_Analysis and batch_roi_export_to_table server scripts
+have their own copy of points_string_to_array(): the OMERO processor runs an
+uploaded script on its own, with only OMERO_HOME/lib/python on its PYTHONPATH.
+Run this module to benchmark parsing of large polylines.
+"""
+
+import timeit
+
+import numpy
+
+
+def points_string_to_array(string):
+    """
+    Convert string to a float array of (x,y) points, with shape (N, 2).
+
+    Expects string in format generated from omero.model.ShapeI.getPoints()
+    e.g. "points[309,427, 366,503]" or "309,427 366,503".
+    Only the first list of the legacy "points[] points1[] points2[]" format
+    is used.
+    """
+    string = string.strip()
+    if string.startswith("points"):
+        start = string.find("[")
+        end = string.find("]", start)
+        if start < 0 or end < 0:
+            raise ValueError(
+                "Unrecognised ROI shape 'points' string: %s" % string)
+        string = string[start + 1:end]
+    elif not string:
+        raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return outline_string_to_array(string)
+
+
+def outline_string_to_array(string):
+    """
+    Convert x,y coordinates to an array with shape (N, 2).
+
+    Commas and whitespace both separate values, so this parses
+    "309,427 366,503" as well as "309,427,366,503" from cellpose
+    io.outlines_to_text(), in a single pass.
+    """
+    try:
+        coords = numpy.fromstring(string.replace(",", " "),
+                                  dtype=numpy.float64, sep=" ")
+    except ValueError:
+        coords = numpy.empty(0)
+    if coords.size == 0 or coords.size % 2 != 0:
+        raise ValueError("Unrecognised ROI shape 'points' string: %s" % string)
+    return coords.reshape(-1, 2)
+
+
+def points_string_to_xy_list(string):
+    """
+    Convert string to list of (x,y) points.
+
+    Expects string in format generated from omero.model.ShapeI.getPoints()
+    e.g. "points[309,427, 366,503]" to [(309,427), (366,503)]
+    """
+    return [tuple(xy) for xy in points_string_to_array(string).tolist()]
+
+
+def array_to_points_string(xy):
+    """
+    Convert (x,y) points to a string for omero.model.ShapeI.setPoints().
+
+    e.g. [(309,427), (366,503)] to "309.0,427.0 366.0,503.0"
+    """
+    values = ["%r" % v
+              for v in numpy.asarray(xy, dtype=float).ravel().tolist()]
+    return " ".join(map(",".join, zip(values[0::2], values[1::2])))
+
+
+def _legacy_points_string_to_xy_list(string):
+    """Previous parser of the Kymograph scripts, used for benchmarking."""
+    point_lists = string.strip().split("points")
+    first_list = point_lists[1]
+    xy_list = []
+    for xy in first_list.strip(" []").split(", "):
+        x, y = xy.split(",")
+        xy_list.append((float(x.strip()), float(y.strip())))
+    return xy_list
+
+
+def benchmark(sizes=(100, 10000, 100000), repeat=5):
+    """Print the time to parse polylines with sizes number of points."""
+    for size in sizes:
+        xy = numpy.random.uniform(0, 10000, (size, 2)).round(2)
+        string = "points[%s]" % ", ".join(
+            ["%s,%s" % tuple(p) for p in xy.tolist()])
+        legacy = min(timeit.repeat(
+            lambda: _legacy_points_string_to_xy_list(string),
+            number=1, repeat=repeat))
+        new = min(timeit.repeat(lambda: points_string_to_array(string),
+                                number=1, repeat=repeat))
+        print("%s points: legacy %.4fs, numpy %.4fs (x%.1f)"
+              % (size, legacy, new, legacy / new))
+
+
+if __name__ == "__main__":
+    benchmark()